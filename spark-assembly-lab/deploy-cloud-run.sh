@@ -72,11 +72,12 @@ gcloud run deploy "$SERVICE_NAME" \
     --platform managed \
     --region "$REGION" \
     --allow-unauthenticated \
-    --set-env-vars "GITHUB_OWNER=rvishravars,GITHUB_REPO=primer,GITHUB_BRANCH=main,GITHUB_SPARKS_PATH=sparks,SPARK_CACHE_TTL_SECONDS=60" \
-    --memory 128Mi \
+    --set-env-vars "GITHUB_OWNER=rvishravars,GITHUB_REPO=primer,GITHUB_BRANCH=main,GITHUB_SPARKS_PATH=sparks,SPARK_CACHE_TTL_SECONDS=60,WEB_CONCURRENCY=1" \
+    --memory 256Mi \
     --cpu 1 \
     --max-instances 1 \
     --port 8080 \
+    --startup-probe "httpGet.path=/api/ready,periodSeconds=5,failureThreshold=48" \
     --quiet
 
 echo ""
@@ -84,4 +85,4 @@ echo "🎉 Deployment complete!"
 SERVICE_URL=$(gcloud run services describe "$SERVICE_NAME" --platform managed --region "$REGION" --format 'value(status.url)')
 echo "🌐 Your app is live at: $SERVICE_URL"
 echo ""
-echo "💡 Note: This deployment is configured for the GCP Free Tier (128Mi RAM, 1 CPU, 1 Max Instance)."
+echo "💡 Note: This deployment is configured for the GCP Free Tier (256Mi RAM, 1 CPU, 1 Max Instance, 1 worker process)."
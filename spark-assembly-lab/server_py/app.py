@@ -4,16 +4,34 @@ Spark Assembly Lab Python backend.
 Replaces the Node/Express server with Flask.
 """
 
+import gzip
+import hashlib
+import hmac
+import http.client
+import io
 import json
+import math
 import os
+import random
+import re
+import sqlite3
+import ssl
+import sys
+import threading
 import time
+import urllib.error
 import urllib.parse
-import urllib.request
 import base64
+import contextvars
+import heapq
+import itertools
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
 
 # Import AI SDKs
 try:
@@ -28,6 +46,24 @@ try:
 except ImportError:
     ANTHROPIC_AVAILABLE = False
 
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
 
 APP_ROOT = Path(__file__).resolve().parents[1]
 DIST_PATH = APP_ROOT / "dist"
@@ -45,15 +81,930 @@ def after_request(response):
     app.logger.debug('Response Status: %s', response.status)
     return response
 
-cache: Dict[str, Any] = {
-    "timestamp": 0,
-    "data": None,
-}
+class LRUCache:
+    """Thread-safe, size-bounded cache with least-recently-used eviction.
+
+    Entries remember when they were stored (epoch milliseconds) so callers
+    can apply their own freshness rules, e.g. serving stale data while a
+    refresh runs.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, Tuple[int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_entry(self, key: str) -> Optional[Tuple[int, Any]]:
+        """Return (stored_at_ms, value) for key, or None when absent."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get(self, key: str, max_age_ms: Optional[int] = None) -> Any:
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if max_age_ms is not None and int(time.time() * 1000) - stored_at >= max_age_ms:
+            return None
+        return value
+
+    def set(self, key: str, value: Any, stored_at: Optional[int] = None) -> None:
+        if stored_at is None:
+            stored_at = int(time.time() * 1000)
+        with self._lock:
+            self._entries[key] = (stored_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SharedCacheBackend:
+    """SQLite database (WAL mode) holding cache entries for every worker process.
+
+    Several server processes on one host point SPARK_SHARED_CACHE_PATH at the
+    same file; a GitHub crawl stored by one worker is then read by all of
+    them. Also provides short leases so only one process at a time performs
+    a given refresh. Values are stored as JSON.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, stored_at INTEGER NOT NULL, "
+                "value TEXT NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_age ON entries (namespace, stored_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, expires_at INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, namespace: str, key: str, newer_than: int = -1) -> Optional[Tuple[int, Any]]:
+        """Return (stored_at, value); value is None when not newer than newer_than."""
+        row = self._connect().execute(
+            "SELECT stored_at, CASE WHEN stored_at > ? THEN value END FROM entries WHERE namespace = ? AND key = ?",
+            (newer_than, namespace, key),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], (json.loads(row[1]) if row[1] is not None else None)
+
+    def store(self, namespace: str, key: str, value: Any, stored_at: int) -> None:
+        self._connect().execute(
+            "INSERT INTO entries (namespace, key, stored_at, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET stored_at = excluded.stored_at, value = excluded.value "
+            "WHERE excluded.stored_at >= entries.stored_at",
+            (namespace, key, stored_at, json.dumps(value)),
+        )
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._connect().execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def keys(self, namespace: str) -> List[str]:
+        return [row[0] for row in self._connect().execute("SELECT key FROM entries WHERE namespace = ?", (namespace,))]
+
+    def prune(self, namespace: str, max_entries: int) -> None:
+        """Drop the oldest entries of namespace beyond max_entries."""
+        self._connect().execute(
+            "DELETE FROM entries WHERE namespace = ? AND key IN ("
+            "SELECT key FROM entries WHERE namespace = ? ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (namespace, namespace, max_entries),
+        )
+
+    def acquire_lease(self, name: str, ttl_seconds: int) -> bool:
+        """Take the named lease unless another process holds an unexpired one."""
+        now = int(time.time() * 1000)
+        conn = self._connect()
+        conn.execute("DELETE FROM leases WHERE name = ? AND expires_at <= ?", (name, now))
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO leases (name, expires_at) VALUES (?, ?)",
+            (name, now + ttl_seconds * 1000),
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str) -> None:
+        self._connect().execute("DELETE FROM leases WHERE name = ?", (name,))
+
+
+class SharedCache:
+    """LRUCache-compatible cache layered over a SharedCacheBackend.
+
+    Entries are kept in a local LRU and written through to SQLite. A read
+    of a mutable namespace asks SQLite whether another worker stored a newer
+    value and only then loads it; immutable namespaces (content addressed
+    by SHA) trust a local hit outright. Database errors fall back to the
+    local copy so a locked or missing file never fails a request.
+    """
+
+    PRUNE_EVERY = 64
+
+    def __init__(self, backend: SharedCacheBackend, namespace: str, max_entries: int, immutable: bool = False):
+        self.backend = backend
+        self.namespace = namespace
+        self.immutable = immutable
+        self.max_entries = max(1, max_entries)
+        self.local = LRUCache(max_entries)
+        self.shared_hits = 0
+        self._writes = 0
+
+    def get_entry(self, key: str) -> Optional[Tuple[int, Any]]:
+        local = self.local.get_entry(key)
+        if local is not None and self.immutable:
+            return local
+        try:
+            row = self.backend.load(self.namespace, key, newer_than=local[0] if local else -1)
+        except sqlite3.Error as err:
+            print(f"Shared cache read failed ({self.namespace}): {err}")
+            return local
+        if row is None:
+            # Not in the shared store (evicted or invalidated elsewhere).
+            if local is not None and not self.immutable:
+                self.local.pop(key)
+                return None
+            return local
+        stored_at, value = row
+        if value is None:
+            return local
+        self.local.set(key, value, stored_at=stored_at)
+        self.shared_hits += 1
+        return stored_at, value
+
+    def get(self, key: str, max_age_ms: Optional[int] = None) -> Any:
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if max_age_ms is not None and int(time.time() * 1000) - stored_at >= max_age_ms:
+            return None
+        return value
+
+    def set(self, key: str, value: Any, stored_at: Optional[int] = None) -> None:
+        if stored_at is None:
+            stored_at = int(time.time() * 1000)
+        self.local.set(key, value, stored_at=stored_at)
+        try:
+            self.backend.store(self.namespace, key, value, stored_at)
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self.backend.prune(self.namespace, self.max_entries)
+        except (sqlite3.Error, TypeError, ValueError) as err:
+            print(f"Shared cache write failed ({self.namespace}): {err}")
+
+    def pop(self, key: str) -> Any:
+        value = self.local.pop(key)
+        try:
+            self.backend.delete(self.namespace, key)
+        except sqlite3.Error as err:
+            print(f"Shared cache delete failed ({self.namespace}): {err}")
+        return value
+
+    def keys(self) -> List[str]:
+        try:
+            return self.backend.keys(self.namespace)
+        except sqlite3.Error:
+            return self.local.keys()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.local.stats(), "backend": "sqlite", "shared_hits": self.shared_hits}
+
+
+# Set SPARK_SHARED_CACHE_PATH to share GitHub-derived caches between worker
+# processes; without it every cache is process-local.
+shared_cache_backend = (
+    SharedCacheBackend(os.environ["SPARK_SHARED_CACHE_PATH"])
+    if os.environ.get("SPARK_SHARED_CACHE_PATH") else None
+)
+
+
+def make_cache(namespace: str, max_entries: int, immutable: bool = False) -> Any:
+    """A SharedCache when a shared backend is configured, otherwise an LRUCache."""
+    if shared_cache_backend is None:
+        return LRUCache(max_entries)
+    return SharedCache(shared_cache_backend, namespace, max_entries, immutable=immutable)
+
+
+def shared_generation(name: str) -> int:
+    """When any worker last invalidated name (epoch ms; 0 without a shared backend)."""
+    if shared_cache_backend is None:
+        return 0
+    try:
+        row = shared_cache_backend.load("generations", name, newer_than=sys.maxsize)
+    except sqlite3.Error:
+        return 0
+    return row[0] if row else 0
+
+
+def bump_shared_generation(name: str) -> int:
+    """Tell other workers that their in-memory copy of name is out of date.
+
+    Returns the generation written (0 when nothing was written).
+    """
+    if shared_cache_backend is None:
+        return 0
+    generation = int(time.time() * 1000)
+    try:
+        shared_cache_backend.store("generations", name, None, generation)
+    except sqlite3.Error as err:
+        print(f"Shared cache write failed (generations): {err}")
+        return 0
+    return generation
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait and receive the same result, or the same exception.
+    Nothing is cached once the call completes. Counts are kept per
+    namespace for /api/metrics.
+    """
 
-pr_cache: Dict[str, Any] = {
-    "timestamp": 0,
-    "data": {},
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def do(self, namespace: str, key: str, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {"leaders": 0, "coalesced": 0})
+            call = self._calls.get((namespace, key))
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[(namespace, key)] = call
+                stats["leaders"] += 1
+            else:
+                stats["coalesced"] += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func()
+            return call["result"]
+        except BaseException as err:
+            call["error"] = err
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop((namespace, key), None)
+            call["done"].set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = Counter(namespace for namespace, _ in self._calls)
+            return {
+                namespace: {**counts, "in_flight": in_flight.get(namespace, 0)}
+                for namespace, counts in self._stats.items()
+            }
+
+
+single_flight = SingleFlight()
+
+
+# Spark listings keyed by "owner/repo:branch".
+spark_cache = make_cache("sparks", int(os.environ.get("SPARK_CACHE_MAX_ENTRIES", "32")))
+_spark_refreshes: set = set()
+_spark_refreshes_lock = threading.Lock()
+
+class PooledResponse:
+    """Fully read HTTP response returned by HTTPConnectionPool."""
+
+    def __init__(self, url: str, status: int, reason: str, headers: http.client.HTTPMessage, body: bytes):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def text(self) -> str:
+        return self.body.decode("utf-8")
+
+
+# Retry and circuit-breaker settings. Policies are looked up by endpoint
+# ("model_infer", "workbench", "agents_run"), then by upstream (a GitHub host
+# such as "api.github.com", "openai", "anthropic"), then "github" for any
+# GitHub host, then the defaults. Override with RESILIENCE_POLICIES, e.g.
+# '{"agents_run": {"attempts": 2}, "openai": {"failure_threshold": 3}}'.
+RESILIENCE_DEFAULTS = {
+    "attempts": 3,
+    "base_delay_ms": 200,
+    "max_delay_ms": 3000,
+    "failure_threshold": 5,
+    "reset_seconds": 30,
 }
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+
+
+def resilience_policy(*names: str) -> Dict[str, Any]:
+    """Settings for the first of names with an override, over the defaults."""
+    try:
+        overrides = json.loads(os.environ.get("RESILIENCE_POLICIES") or "{}")
+    except ValueError:
+        overrides = {}
+    for name in names:
+        if name in overrides:
+            return {**RESILIENCE_DEFAULTS, **overrides[name]}
+    return dict(RESILIENCE_DEFAULTS)
+
+
+def retry_delay(policy: Dict[str, Any], attempt: int) -> float:
+    """Exponential backoff with full jitter, in seconds."""
+    cap = min(policy["max_delay_ms"], policy["base_delay_ms"] * (2 ** attempt))
+    return random.uniform(0, cap) / 1000
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is temporarily unavailable (circuit open); retry in {int(retry_in) + 1}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Fails fast while an upstream keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are rejected for reset_seconds; then a single probe call is let through
+    and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = {"opened": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Admit a call or raise CircuitOpenError; True when it is the probe."""
+        with self._lock:
+            now = time.time()
+            if self.state == "open":
+                if now - self.opened_at < self.reset_seconds:
+                    self.counters["rejected"] += 1
+                    raise CircuitOpenError(self.name, self.opened_at + self.reset_seconds - now)
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open":
+                if self.probing:
+                    self.counters["rejected"] += 1
+                    raise CircuitOpenError(self.name, 1)
+                self.probing = True
+                return True
+            return False
+
+    def release_probe(self) -> None:
+        """Give up a probe that ended without an outcome (e.g. a cancelled stream)."""
+        with self._lock:
+            if self.state == "half_open":
+                self.probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.counters["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, **self.counters}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_resilience_lock = threading.Lock()
+resilience_counters: Dict[str, Dict[str, int]] = {"retries": {}, "stale_served": {}}
+
+
+def get_breaker(name: str, *policy_names: str) -> CircuitBreaker:
+    with _resilience_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            policy = resilience_policy(name, *policy_names)
+            breaker = CircuitBreaker(name, int(policy["failure_threshold"]), float(policy["reset_seconds"]))
+            _breakers[name] = breaker
+        return breaker
+
+
+def count_resilience(kind: str, name: str) -> None:
+    with _resilience_lock:
+        resilience_counters[kind][name] = resilience_counters[kind].get(name, 0) + 1
+
+
+def resilience_stats() -> Dict[str, Any]:
+    with _resilience_lock:
+        breakers = dict(_breakers)
+        counters = {kind: dict(values) for kind, values in resilience_counters.items()}
+    return {"breakers": {name: breaker.stats() for name, breaker in breakers.items()}, **counters}
+
+
+def is_retryable_llm_error(err: Exception) -> bool:
+    """Connection problems, timeouts, rate limits and 5xx from the LLM SDKs."""
+    status = getattr(err, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return type(err).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(err, (ConnectionError, TimeoutError))
+
+
+def call_llm(provider: str, endpoint: str, func: Callable[[], Any]) -> Any:
+    """Call an LLM API through its circuit breaker, retrying transient errors."""
+    policy = resilience_policy(endpoint, provider)
+    breaker = get_breaker(provider)
+    attempts = max(1, int(policy["attempts"]))
+    for attempt in range(attempts):
+        breaker.allow()
+        try:
+            result = func()
+        except Exception as err:
+            if not is_retryable_llm_error(err):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise
+            count_resilience("retries", provider)
+            time.sleep(retry_delay(policy, attempt))
+            continue
+        breaker.record_success()
+        return result
+
+
+def guard_llm_stream(provider: str, deltas: Iterator[str]) -> Iterator[str]:
+    """Pass a model stream through the provider's circuit breaker.
+
+    Streams are not retried: deltas may already have reached the client.
+    """
+    breaker = get_breaker(provider)
+    probe = breaker.allow()
+    settled = False
+    try:
+        yield from deltas
+    except Exception as err:
+        settled = True
+        if is_retryable_llm_error(err):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    else:
+        settled = True
+        breaker.record_success()
+    finally:
+        # A client disconnect closes the stream (GeneratorExit) without an
+        # outcome; free the probe so the next call can try again.
+        if probe and not settled:
+            breaker.release_probe()
+
+
+# Priority of the GitHub calls made by the current request or job; lower
+# values are served first when the rate-limit budget is tight.
+GITHUB_PRIORITIES = {"interactive": 0, "crawl": 1, "background": 2}
+_github_priority: contextvars.ContextVar = contextvars.ContextVar("github_priority", default=0)
+
+
+@contextmanager
+def github_priority(name: str) -> Iterator[None]:
+    """Run the enclosed GitHub calls at priority name (never raising it)."""
+    token = _github_priority.set(max(_github_priority.get(), GITHUB_PRIORITIES[name]))
+    try:
+        yield
+    finally:
+        _github_priority.reset(token)
+
+
+class GitHubRateLimiter:
+    """Schedules api.github.com requests against each token's rate limit.
+
+    Budgets are tracked per credential and resource (core, search, graphql)
+    from the X-RateLimit-* headers of every response. Waiting requests are
+    released in priority order (interactive, then crawl, then background):
+      - below slowdown_fraction of the limit, requests are spaced so the
+        remaining budget lasts until the reset time;
+      - below reserve_fraction, background requests wait for the reset so
+        the rest is kept for interactive use;
+      - Retry-After and secondary-limit responses pause the whole bucket.
+    A request that would have to wait longer than max_wait_seconds fails
+    with a 403 HTTPError instead (background jobs wait up to an hour).
+    """
+
+    def __init__(self, reserve_fraction: float, slowdown_fraction: float, max_wait_seconds: float):
+        self.reserve_fraction = reserve_fraction
+        self.slowdown_fraction = slowdown_fraction
+        self.max_wait_seconds = max_wait_seconds
+        self._cond = threading.Condition()
+        self._buckets: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._queues: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+        self._seq = itertools.count()
+        self.counters = {"throttled": 0, "rejected": 0, "rate_limited_responses": 0, "waited_ms": 0}
+
+    def bucket_for(self, url: str, headers: Dict[str, str]) -> Optional[Tuple[str, str]]:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.hostname != "api.github.com":
+            return None
+        # Named as GitHub's X-RateLimit-Resource header names them, since
+        # record() files each response under that header's value.
+        if parsed.path == "/search/code":
+            resource = "code_search"
+        elif parsed.path.startswith("/search/"):
+            resource = "search"
+        elif parsed.path == "/graphql":
+            resource = "graphql"
+        else:
+            resource = "core"
+        return credential_fingerprint(headers), resource
+
+    def _state(self, bucket: Tuple[str, str]) -> Dict[str, Any]:
+        state = self._buckets.get(bucket)
+        if state is None:
+            state = {"limit": None, "remaining": None, "reset_at": 0.0, "blocked_until": 0.0, "last_sent": 0.0}
+            self._buckets[bucket] = state
+        return state
+
+    def _delay(self, state: Dict[str, Any], priority: int, now: float) -> float:
+        if state["blocked_until"] > now:
+            return state["blocked_until"] - now
+        remaining, limit = state["remaining"], state["limit"]
+        if remaining is None or not limit or state["reset_at"] <= now:
+            return 0.0
+        until_reset = state["reset_at"] - now
+        if remaining <= 0:
+            return until_reset
+        if priority >= GITHUB_PRIORITIES["background"] and remaining <= limit * self.reserve_fraction:
+            return until_reset
+        if remaining <= limit * self.slowdown_fraction:
+            interval = until_reset / remaining
+            if priority == GITHUB_PRIORITIES["interactive"]:
+                interval /= 4
+            return max(0.0, state["last_sent"] + interval - now)
+        return 0.0
+
+    def acquire(self, bucket: Tuple[str, str], url: str) -> None:
+        priority = _github_priority.get()
+        max_wait = 3600.0 if priority >= GITHUB_PRIORITIES["background"] else self.max_wait_seconds
+        ticket = (priority, next(self._seq))
+        started = time.time()
+        with self._cond:
+            queue = self._queues.setdefault(bucket, [])
+            heapq.heappush(queue, ticket)
+            throttled = False
+            try:
+                while True:
+                    now = time.time()
+                    state = self._state(bucket)
+                    delay = self._delay(state, priority, now)
+                    if queue[0] == ticket and delay <= 0:
+                        heapq.heappop(queue)
+                        state["last_sent"] = now
+                        if state["remaining"] is not None:
+                            state["remaining"] -= 1
+                        if throttled:
+                            self.counters["throttled"] += 1
+                            self.counters["waited_ms"] += int((now - started) * 1000)
+                        return
+                    if delay > 0 and now + delay - started > max_wait:
+                        queue.remove(ticket)
+                        heapq.heapify(queue)
+                        self.counters["rejected"] += 1
+                        raise urllib.error.HTTPError(
+                            url, 403, f"GitHub API rate limit exceeded; retry in {int(delay) + 1}s",
+                            {"Retry-After": str(int(delay) + 1)}, io.BytesIO(b""),
+                        )
+                    throttled = True
+                    self._cond.wait(timeout=min(delay, 1.0) if delay > 0 else 1.0)
+            finally:
+                self._cond.notify_all()
+
+    def record(self, bucket: Tuple[str, str], response: "PooledResponse") -> bool:
+        """Update the budget from a response; True when it was rate limited."""
+        headers = response.headers
+        now = time.time()
+        resource = headers.get("X-RateLimit-Resource")
+        if resource:
+            bucket = (bucket[0], resource)
+        limited = False
+        with self._cond:
+            state = self._state(bucket)
+            try:
+                if headers.get("X-RateLimit-Limit") is not None:
+                    state["limit"] = int(headers["X-RateLimit-Limit"])
+                if headers.get("X-RateLimit-Remaining") is not None:
+                    state["remaining"] = int(headers["X-RateLimit-Remaining"])
+                if headers.get("X-RateLimit-Reset") is not None:
+                    state["reset_at"] = float(headers["X-RateLimit-Reset"])
+            except ValueError:
+                pass
+            if response.status in (403, 429):
+                retry_after = headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    state["blocked_until"] = now + int(retry_after)
+                    limited = True
+                elif state["remaining"] == 0 and state["reset_at"] > now:
+                    state["blocked_until"] = state["reset_at"]
+                    limited = True
+                elif response.status == 429 or b"secondary rate limit" in response.body.lower():
+                    # GitHub asks clients to wait at least a minute here.
+                    state["blocked_until"] = now + 60
+                    limited = True
+            if limited:
+                self.counters["rate_limited_responses"] += 1
+            self._cond.notify_all()
+        return limited
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._cond:
+            buckets = {
+                f"{fingerprint}:{resource}": {
+                    "limit": state["limit"],
+                    "remaining": state["remaining"],
+                    "reset_in_seconds": max(0, int(state["reset_at"] - now)) if state["reset_at"] else None,
+                    "blocked_for_seconds": max(0, int(state["blocked_until"] - now)),
+                    "waiting": len(self._queues.get((fingerprint, resource), [])),
+                }
+                for (fingerprint, resource), state in self._buckets.items()
+            }
+            return {**self.counters, "buckets": buckets}
+
+
+class HTTPConnectionPool:
+    """Shared, thread-safe keep-alive connection pool for GitHub traffic.
+
+    Connections are kept per (scheme, host, port) and reused across
+    requests and threads, so repeated calls to api.github.com or
+    raw.githubusercontent.com skip the TCP and TLS handshakes. At most
+    max_per_host connections are open to one host; further callers wait
+    for a free connection. Error responses are raised as
+    urllib.error.HTTPError so existing callers keep their handling. With a
+    scheduler, api.github.com requests wait for rate-limit budget and a
+    rate-limited GET is retried once after the requested pause. Every host
+    has a circuit breaker, and transient failures of GET/HEAD are retried.
+    """
+
+    RETRYABLE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_per_host: int, timeout: float, scheduler: Optional[GitHubRateLimiter] = None):
+        self.max_per_host = max(1, max_per_host)
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self._ssl_context = ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._hosts: Dict[Tuple[str, str, int], Dict[str, Any]] = {}
+
+    def _host_pool(self, key: Tuple[str, str, int]) -> Dict[str, Any]:
+        with self._lock:
+            pool = self._hosts.get(key)
+            if pool is None:
+                pool = {
+                    "idle": [],
+                    "slots": threading.BoundedSemaphore(self.max_per_host),
+                    "in_use": 0,
+                    "created": 0,
+                    "reused": 0,
+                    "requests": 0,
+                }
+                self._hosts[key] = pool
+            return pool
+
+    def _checkout(self, key: Tuple[str, str, int], pool: Dict[str, Any]) -> Tuple[http.client.HTTPConnection, bool]:
+        # Block rather than fail: every slot holder is bounded by the socket
+        # timeout, and a full pool says nothing about the host's health, so
+        # it must not surface as a retryable error or a breaker failure.
+        pool["slots"].acquire()
+        with self._lock:
+            pool["in_use"] += 1
+            pool["requests"] += 1
+            if pool["idle"]:
+                pool["reused"] += 1
+                return pool["idle"].pop(), True
+            pool["created"] += 1
+        scheme, host, port = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _checkin(self, pool: Dict[str, Any], conn: http.client.HTTPConnection, reusable: bool) -> None:
+        if not reusable:
+            conn.close()
+        with self._lock:
+            pool["in_use"] -= 1
+            if reusable:
+                pool["idle"].append(conn)
+        pool["slots"].release()
+
+    def _send(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes]) -> PooledResponse:
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or "https"
+        port = parsed.port or (443 if scheme == "https" else 80)
+        key = (scheme, parsed.hostname or "", port)
+        target = parsed.path or "/"
+        if parsed.query:
+            target = f"{target}?{parsed.query}"
+
+        request_headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive", **headers}
+        pool = self._host_pool(key)
+        attempts = 0
+        while True:
+            attempts += 1
+            conn, reused = self._checkout(key, pool)
+            sent = False
+            try:
+                conn.request(method, target, body=body, headers=request_headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except self.RETRYABLE_ERRORS:
+                self._checkin(pool, conn, reusable=False)
+                # A kept-alive connection may have been closed by the server
+                # while idle; retry once on a fresh one when that is safe.
+                if reused and attempts == 1 and (not sent or method in ("GET", "HEAD")):
+                    continue
+                raise
+            except Exception:
+                self._checkin(pool, conn, reusable=False)
+                raise
+            self._checkin(pool, conn, reusable=not response.will_close)
+            break
+
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            data = gzip.decompress(data)
+        return PooledResponse(url, response.status, response.reason, response.msg, data)
+
+    def _send_resilient(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        body: Optional[bytes],
+        bucket: Optional[Tuple[str, str]],
+    ) -> PooledResponse:
+        """_send through the host's circuit breaker, retrying idempotent calls.
+
+        Connection errors and 5xx responses count as failures; GET and HEAD
+        are retried with jittered exponential backoff.
+        """
+        host = urllib.parse.urlsplit(url).hostname or ""
+        policy = resilience_policy(host, "github")
+        breaker = get_breaker(host, "github")
+        attempts = max(1, int(policy["attempts"])) if method in ("GET", "HEAD") else 1
+        for attempt in range(attempts):
+            # Wait for rate-limit budget before taking a breaker probe, so a
+            # rejected wait cannot leave a half-open breaker probing forever.
+            if bucket:
+                self.scheduler.acquire(bucket, url)
+            probe = breaker.allow()
+            try:
+                response = self._send(method, url, headers, body)
+            except (OSError, http.client.HTTPException):
+                breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+            except BaseException:
+                if probe:
+                    breaker.release_probe()
+                raise
+            else:
+                if response.status < 500:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    return response
+            count_resilience("retries", host)
+            time.sleep(retry_delay(policy, attempt))
+        raise AssertionError("unreachable")
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: Optional[bytes] = None,
+        max_redirects: int = 5,
+    ) -> PooledResponse:
+        headers = dict(headers or {})
+        redirects = 0
+        rate_limit_retries = 1
+        while True:
+            bucket = self.scheduler.bucket_for(url, headers) if self.scheduler else None
+            response = self._send_resilient(method, url, headers, body, bucket)
+            if bucket and self.scheduler.record(bucket, response) and method in ("GET", "HEAD") and rate_limit_retries:
+                rate_limit_retries -= 1
+                continue
+            location = response.headers.get("Location")
+            if response.status in self.REDIRECT_CODES and location and method in ("GET", "HEAD"):
+                redirects += 1
+                if redirects > max_redirects:
+                    raise urllib.error.URLError(f"Too many redirects for {url}")
+                next_url = urllib.parse.urljoin(url, location)
+                if urllib.parse.urlsplit(next_url).hostname != urllib.parse.urlsplit(url).hostname:
+                    headers.pop("Authorization", None)
+                url = next_url
+                continue
+            if response.status >= 300:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(response.body))
+            return response
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hosts = {
+                f"{scheme}://{host}:{port}": {
+                    "idle": len(pool["idle"]),
+                    "in_use": pool["in_use"],
+                    "created": pool["created"],
+                    "reused": pool["reused"],
+                    "requests": pool["requests"],
+                }
+                for (scheme, host, port), pool in self._hosts.items()
+            }
+        return {"max_per_host": self.max_per_host, "timeout_seconds": self.timeout, "hosts": hosts}
+
+
+github_rate_limiter = GitHubRateLimiter(
+    float(os.environ.get("GITHUB_RATE_LIMIT_RESERVE_FRACTION", "0.1")),
+    float(os.environ.get("GITHUB_RATE_LIMIT_SLOWDOWN_FRACTION", "0.2")),
+    float(os.environ.get("GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS", "20")),
+)
+
+http_pool = HTTPConnectionPool(
+    int(os.environ.get("GITHUB_POOL_MAX_PER_HOST", "10")),
+    float(os.environ.get("GITHUB_HTTP_TIMEOUT_SECONDS", "30")),
+    scheduler=github_rate_limiter,
+)
+
+# Validators (ETag / Last-Modified) and decoded bodies of GitHub GET
+# responses, used to revalidate with conditional requests. GitHub does not
+# count 304 responses against the rate limit.
+conditional_cache = make_cache("conditional", int(os.environ.get("GITHUB_CONDITIONAL_CACHE_MAX_ENTRIES", "2048")))
+conditional_stats: Dict[str, int] = {"requests": 0, "not_modified": 0, "stored": 0}
+_conditional_stats_lock = threading.Lock()
+
+# Spark file contents keyed by git blob SHA, and last-commit metadata keyed by
+# repo, branch, path and blob SHA. A file whose blob is unchanged keeps both.
+blob_cache = make_cache("blobs", int(os.environ.get("SPARK_BLOB_CACHE_MAX_ENTRIES", "1024")), immutable=True)
+last_commit_cache = make_cache("last_commits", int(os.environ.get("SPARK_BLOB_CACHE_MAX_ENTRIES", "1024")), immutable=True)
+
+# /api/prs responses keyed by "owner/repo:path".
+pr_cache = make_cache("prs", int(os.environ.get("PR_CACHE_MAX_ENTRIES", "1024")))
 
 
 def get_env(key: str, fallback: str) -> str:
@@ -91,32 +1042,128 @@ def parse_repo_url(input_value: str) -> Dict[str, str]:
     raise ValueError("Invalid repository format. Use: owner/repo or https://github.com/owner/repo")
 
 
+def credential_fingerprint(headers: Dict[str, str]) -> str:
+    """Short, non-reversible identifier for the credentials in headers."""
+    auth = headers.get("Authorization")
+    if not auth:
+        return "anonymous"
+    return hashlib.sha256(auth.encode("utf-8")).hexdigest()[:16]
+
+
+def _count_conditional(stat: str) -> None:
+    with _conditional_stats_lock:
+        conditional_stats[stat] += 1
+
+
+def fetch_conditional_page(url: str, headers: Dict[str, str]) -> Tuple[str, Optional[str]]:
+    """GET url and return (decoded body, Link header), revalidating cached copies.
+
+    When an earlier response for the same URL and credentials carried an
+    ETag or Last-Modified header, the request is sent with If-None-Match /
+    If-Modified-Since and a 304 answer is served from the stored body.
+    """
+    cache_key = f"{credential_fingerprint(headers)}:{url}"
+    # Identical GETs in flight at the same time share one upstream request.
+    return single_flight.do("github_get", cache_key, lambda: _fetch_conditional_page(url, headers, cache_key))
+
+
+def _fetch_conditional_page(url: str, headers: Dict[str, str], cache_key: str) -> Tuple[str, Optional[str]]:
+    stored = conditional_cache.get(cache_key)
+    request_headers = dict(headers)
+    if stored:
+        if stored.get("etag"):
+            request_headers["If-None-Match"] = stored["etag"]
+        if stored.get("last_modified"):
+            request_headers["If-Modified-Since"] = stored["last_modified"]
+
+    _count_conditional("requests")
+    try:
+        response = http_pool.request("GET", url, request_headers)
+        body = response.text()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        link = response.headers.get("Link")
+    except urllib.error.HTTPError as err:
+        if err.code == 304 and stored:
+            _count_conditional("not_modified")
+            return stored["body"], stored.get("link")
+        if err.code >= 500 and stored:
+            count_resilience("stale_served", "github_get")
+            return stored["body"], stored.get("link")
+        raise
+    except (OSError, http.client.HTTPException, CircuitOpenError):
+        # Upstream unreachable or its circuit is open: serve the last copy.
+        if stored:
+            count_resilience("stale_served", "github_get")
+            return stored["body"], stored.get("link")
+        raise
+
+    if etag or last_modified:
+        conditional_cache.set(cache_key, {
+            "etag": etag,
+            "last_modified": last_modified,
+            "link": link,
+            "body": body,
+        })
+        _count_conditional("stored")
+    return body, link
+
+
+def fetch_conditional(url: str, headers: Dict[str, str]) -> str:
+    return fetch_conditional_page(url, headers)[0]
+
+
+def parse_next_link(link_header: Optional[str]) -> Optional[str]:
+    """Return the rel="next" URL from a GitHub Link header, if any."""
+    for part in (link_header or "").split(","):
+        segments = part.split(";")
+        if len(segments) < 2:
+            continue
+        if any(segment.strip() == 'rel="next"' for segment in segments[1:]):
+            return segments[0].strip().lstrip("<").rstrip(">")
+    return None
+
+
+def iter_github_list(url: str, headers: Dict[str, str], max_items: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Lazily yield the items of a paginated GitHub list endpoint.
+
+    Pages are requested one at a time by following Link: rel="next", and
+    only when the caller has consumed the previous page, so a caller that
+    stops iterating (or reaches max_items) never requests the rest.
+    """
+    next_url: Optional[str] = url
+    yielded = 0
+    while next_url:
+        body, link = fetch_conditional_page(next_url, headers)
+        page = json.loads(body)
+        if not isinstance(page, list):
+            return
+        for item in page:
+            yield item
+            yielded += 1
+            if max_items is not None and yielded >= max_items:
+                return
+        next_url = parse_next_link(link)
+
+
 def fetch_json(url: str, headers: Dict[str, str]) -> Dict[str, Any]:
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req) as response:
-        data = response.read().decode("utf-8")
-        return json.loads(data)
+    return json.loads(fetch_conditional(url, headers))
 
 
 def fetch_text(url: str, headers: Dict[str, str]) -> str:
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req) as response:
-        return response.read().decode("utf-8")
+    return fetch_conditional(url, headers)
 
 
 def fetch_json_with_token(url: str, token: str, method: str = "GET", payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     data = None
     if payload is not None:
         data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(url, data=data, method=method)
-    req.add_header("Authorization", f"Bearer {token}")
-    req.add_header("Accept", "application/vnd.github+json")
-    req.add_header("User-Agent", "spark-assembly-lab")
+    headers = build_github_headers_with_token(token)
     if payload is not None:
-        req.add_header("Content-Type", "application/json")
+        headers["Content-Type"] = "application/json"
     try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode("utf-8"))
+        response = http_pool.request(method, url, headers, data)
+        return json.loads(response.text())
     except urllib.error.HTTPError as e:
         error_body = e.read().decode("utf-8")
         print(f"HTTP Error {e.code}: {e.reason}")
@@ -130,6 +1177,404 @@ def create_github_issue(owner: str, repo: str, token: str, payload: Dict[str, An
     return fetch_json_with_token(url, token, method="POST", payload=payload)
 
 
+class PullRequestIndex:
+    """Inverted index from file path to the open pull requests touching it.
+
+    One index is shared by every /api/prs lookup for a repository. A
+    refresh lists the open PRs once and only re-downloads the file list of
+    PRs whose head SHA or updated_at changed since the previous refresh, so
+    answering a lookup is a dictionary read.
+    """
+
+    def __init__(self, owner: str, repo: str):
+        self.owner = owner
+        self.repo = repo
+        self.refreshed_at = 0
+        self._pulls: Dict[int, Dict[str, Any]] = {}
+        self._by_path: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _fetch_files(self, number: int, headers: Dict[str, str]) -> List[str]:
+        files_url = f"https://api.github.com/repos/{self.owner}/{self.repo}/pulls/{number}/files?per_page=100"
+        return [item.get("filename") for item in iter_github_list(files_url, headers) if item.get("filename")]
+
+    def refresh(self, headers: Dict[str, str]) -> None:
+        pulls_url = f"https://api.github.com/repos/{self.owner}/{self.repo}/pulls?state=open&per_page=100"
+        pulls = [pr for pr in iter_github_list(pulls_url, headers) if pr.get("number")]
+
+        with self._lock:
+            previous = dict(self._pulls)
+
+        def version(pr: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+            return ((pr.get("head") or {}).get("sha"), pr.get("updated_at"))
+
+        changed = [pr for pr in pulls if previous.get(pr["number"], {}).get("version") != version(pr)]
+
+        def load(pr: Dict[str, Any]) -> Optional[List[str]]:
+            try:
+                return self._fetch_files(pr["number"], headers)
+            except Exception as err:
+                print(f"Failed to fetch files for PR #{pr['number']} in {self.owner}/{self.repo}: {err}")
+                return None
+
+        fetched = dict(zip((pr["number"] for pr in changed), run_bounded(load, changed)))
+
+        pull_entries: Dict[int, Dict[str, Any]] = {}
+        by_path: Dict[str, List[int]] = {}
+        for pr in pulls:
+            number = pr["number"]
+            files = fetched.get(number)
+            if files is not None:
+                entry_version = version(pr)
+            elif number in previous:
+                # Unchanged, or its file list could not be refreshed; keep the
+                # previous entry (and version, so a failed fetch is retried).
+                files = previous[number]["files"]
+                entry_version = previous[number]["version"]
+            else:
+                continue
+            pull_entries[number] = {
+                "version": entry_version,
+                "files": files,
+                "item": {
+                    "type": "pr",
+                    "url": pr.get("html_url"),
+                    "number": number,
+                    "user": (pr.get("user") or {}).get("login"),
+                },
+            }
+            for filename in files:
+                by_path.setdefault(filename, []).append(number)
+
+        with self._lock:
+            self._pulls = pull_entries
+            self._by_path = by_path
+            self.refreshed_at = int(time.time() * 1000)
+
+    def ensure_fresh(self, headers: Dict[str, str], max_age_ms: int) -> None:
+        """Refresh the index when it is older than max_age_ms.
+
+        Concurrent callers wait for the refresh already in progress instead
+        of starting their own. An invalidation by another worker process
+        also forces a refresh.
+        """
+        if self._is_fresh(max_age_ms):
+            return
+        with self._refresh_lock:
+            if self._is_fresh(max_age_ms):
+                return
+            self.refresh(headers)
+
+    def _is_fresh(self, max_age_ms: int) -> bool:
+        if int(time.time() * 1000) - self.refreshed_at >= max_age_ms:
+            return False
+        return self.refreshed_at > shared_generation(f"prs:{self.owner}/{self.repo}")
+
+    def invalidate(self) -> None:
+        self.refreshed_at = 0
+        bump_shared_generation(f"prs:{self.owner}/{self.repo}")
+
+    def publish_update(self) -> None:
+        """Tell other workers about a change applied here in place.
+
+        This copy already has the change, so it stays fresh if it was.
+        """
+        name = f"prs:{self.owner}/{self.repo}"
+        was_current = self.refreshed_at > shared_generation(name)
+        generation = bump_shared_generation(name)
+        if was_current:
+            self.refreshed_at = max(self.refreshed_at, generation + 1)
+
+    def _set_pull(self, number: int, entry: Optional[Dict[str, Any]]) -> None:
+        # Caller holds self._lock.
+        previous = self._pulls.pop(number, None)
+        if previous:
+            for filename in previous["files"]:
+                numbers = [n for n in self._by_path.get(filename, []) if n != number]
+                if numbers:
+                    self._by_path[filename] = numbers
+                else:
+                    self._by_path.pop(filename, None)
+        if entry:
+            self._pulls[number] = entry
+            for filename in entry["files"]:
+                self._by_path.setdefault(filename, []).append(number)
+
+    def apply_pull_event(self, pr: Dict[str, Any], headers: Dict[str, str]) -> None:
+        """Update one pull request from a webhook payload.
+
+        Closed PRs are dropped; open ones have their file list re-read. An
+        index that has never been refreshed is left alone, since its first
+        refresh will list everything anyway.
+        """
+        number = pr.get("number")
+        if not number or not self.refreshed_at:
+            return
+        entry = None
+        if pr.get("state") == "open":
+            try:
+                files = self._fetch_files(number, headers)
+            except Exception as err:
+                print(f"Failed to fetch files for PR #{number} in {self.owner}/{self.repo}: {err}")
+                self.invalidate()
+                return
+            entry = {
+                "version": ((pr.get("head") or {}).get("sha"), pr.get("updated_at")),
+                "files": files,
+                "item": {
+                    "type": "pr",
+                    "url": pr.get("html_url"),
+                    "number": number,
+                    "user": (pr.get("user") or {}).get("login"),
+                },
+            }
+        with self._lock:
+            self._set_pull(number, entry)
+
+    def lookup(self, path: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(self._pulls[number]["item"]) for number in self._by_path.get(path, [])]
+
+
+pr_indexes = LRUCache(int(os.environ.get("PR_INDEX_MAX_REPOS", "32")))
+_pr_indexes_lock = threading.Lock()
+
+
+def get_pr_index(owner: str, repo: str) -> PullRequestIndex:
+    key = f"{owner}/{repo}"
+    with _pr_indexes_lock:
+        index = pr_indexes.get(key)
+        if index is None:
+            index = PullRequestIndex(owner, repo)
+            pr_indexes.set(key, index)
+        return index
+
+
+class PatternMatcher:
+    """Aho-Corasick automaton matching many lowercase patterns in one pass.
+
+    find(text) returns every pattern occurring anywhere in text
+    (case-insensitive substring match), scanning each character once
+    regardless of how many patterns there are.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]
+        for pattern in {p.lower() for p in patterns if p}:
+            node = 0
+            for char in pattern:
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[node][char] = len(self._goto) - 1
+                node = self._goto[node][char]
+            self._out[node].append(pattern)
+
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, text: str) -> set:
+        found = set()
+        node = 0
+        for char in text.lower():
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._out[node]:
+                found.update(self._out[node])
+        return found
+
+
+def spark_name_from_path(spark_path: str) -> str:
+    return spark_path.split("/")[-1].replace(".spark.md", "")
+
+
+class IssueStore:
+    """Local copy of a repository's issues, indexed by the sparks they mention.
+
+    The first refresh lists every issue; later refreshes only ask GitHub for
+    issues updated since the newest one seen (the `since=` parameter). Each
+    new or changed issue is run once through a PatternMatcher built from all
+    registered spark names, so contributor and proposal lookups are
+    dictionary reads. With ISSUE_STORE_DIR set the issues are also saved to
+    disk and reloaded on restart.
+    """
+
+    def __init__(self, owner: str, repo: str, directory: Optional[str] = None):
+        self.owner = owner
+        self.repo = repo
+        self.refreshed_at = 0
+        self.since: Optional[str] = None
+        self._issues: Dict[int, Dict[str, Any]] = {}
+        self._names: set = set()
+        self._matcher = PatternMatcher([])
+        self._by_name: Dict[str, set] = {}
+        self._path = Path(directory) / f"{owner}__{repo}.json" if directory else None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        if not self._path or not self._path.exists():
+            return
+        try:
+            stored = json.loads(self._path.read_text(encoding="utf-8"))
+            self.since = stored.get("since")
+            self._issues = {issue["number"]: issue for issue in stored.get("issues", [])}
+        except (OSError, ValueError, KeyError) as err:
+            print(f"Ignoring unreadable issue store {self._path}: {err}")
+            self.since = None
+            self._issues = {}
+
+    def _save(self) -> None:
+        if not self._path:
+            return
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock:
+                snapshot = {"since": self.since, "issues": list(self._issues.values())}
+            tmp_path = self._path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(snapshot), encoding="utf-8")
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            print(f"Failed to save issue store {self._path}: {err}")
+
+    def _index_issue(self, issue: Dict[str, Any]) -> None:
+        # Caller holds self._lock.
+        number = issue["number"]
+        for numbers in self._by_name.values():
+            numbers.discard(number)
+        for name in self._matcher.find(f"{issue['title']}\n{issue['body']}"):
+            self._by_name.setdefault(name, set()).add(number)
+
+    def register_names(self, names: List[str]) -> None:
+        """Add spark names to match; existing issues are rescanned once."""
+        with self._lock:
+            new_names = {name.lower() for name in names if name} - self._names
+            if not new_names:
+                return
+            self._names |= new_names
+            self._matcher = PatternMatcher(list(self._names))
+            self._by_name = {}
+            for issue in self._issues.values():
+                self._index_issue(issue)
+
+    def upsert(self, issues: List[Dict[str, Any]], advance_since: bool = True) -> None:
+        """Store (or replace) issues as returned by the GitHub issues API.
+
+        Issues that arrive outside a sync (webhooks, issues created here)
+        pass advance_since=False so the next sync does not skip anything
+        updated in between.
+        """
+        with self._lock:
+            for issue in issues:
+                if not issue.get("number"):
+                    continue
+                entry = {
+                    "number": issue["number"],
+                    "title": issue.get("title") or "",
+                    "body": issue.get("body") or "",
+                    "state": issue.get("state"),
+                    "is_pr": bool(issue.get("pull_request")),
+                    "html_url": issue.get("html_url"),
+                    "updated_at": issue.get("updated_at"),
+                    "user": {
+                        key: (issue.get("user") or {}).get(key)
+                        for key in ("login", "avatar_url", "html_url")
+                    },
+                }
+                self._issues[entry["number"]] = entry
+                self._index_issue(entry)
+                if advance_since and entry["updated_at"] and (self.since is None or entry["updated_at"] > self.since):
+                    self.since = entry["updated_at"]
+
+    def refresh(self, headers: Dict[str, str]) -> None:
+        url = f"https://api.github.com/repos/{self.owner}/{self.repo}/issues?state=all&per_page=100&sort=updated&direction=asc"
+        if self.since:
+            url += f"&since={urllib.parse.quote(self.since)}"
+        updated = list(iter_github_list(url, headers))
+        self.upsert(updated)
+        self.refreshed_at = int(time.time() * 1000)
+        if updated:
+            self._save()
+
+    def ensure_fresh(self, headers: Dict[str, str], max_age_ms: int) -> None:
+        """Sync with GitHub when older than max_age_ms or changed by another
+        worker; callers share one sync."""
+        if self._is_fresh(max_age_ms):
+            return
+        with self._refresh_lock:
+            if self._is_fresh(max_age_ms):
+                return
+            self.refresh(headers)
+
+    def _is_fresh(self, max_age_ms: int) -> bool:
+        if int(time.time() * 1000) - self.refreshed_at >= max_age_ms:
+            return False
+        return self.refreshed_at > shared_generation(f"issues:{self.owner}/{self.repo}")
+
+    def invalidate(self) -> None:
+        self.refreshed_at = 0
+        bump_shared_generation(f"issues:{self.owner}/{self.repo}")
+
+    def publish_update(self) -> None:
+        """Tell other workers about a change applied here in place.
+
+        This copy already has the change, so it stays fresh if it was.
+        """
+        name = f"issues:{self.owner}/{self.repo}"
+        was_current = self.refreshed_at > shared_generation(name)
+        generation = bump_shared_generation(name)
+        if was_current:
+            self.refreshed_at = max(self.refreshed_at, generation + 1)
+
+    def remove(self, number: int) -> None:
+        with self._lock:
+            if self._issues.pop(number, None) is not None:
+                for numbers in self._by_name.values():
+                    numbers.discard(number)
+
+    def mentions(self, spark_name: str, state: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Issues (not pull requests) whose title or body mention spark_name."""
+        self.register_names([spark_name])
+        with self._lock:
+            numbers = sorted(self._by_name.get(spark_name.lower(), ()))
+            return [
+                dict(self._issues[number]) for number in numbers
+                if not self._issues[number]["is_pr"] and (state is None or self._issues[number]["state"] == state)
+            ]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"issues": len(self._issues), "names": len(self._names), "since": self.since}
+
+
+issue_stores = LRUCache(int(os.environ.get("ISSUE_STORE_MAX_REPOS", "32")))
+_issue_stores_lock = threading.Lock()
+
+
+def get_issue_store(owner: str, repo: str) -> IssueStore:
+    key = f"{owner}/{repo}"
+    with _issue_stores_lock:
+        store = issue_stores.get(key)
+        if store is None:
+            store = IssueStore(owner, repo, os.environ.get("ISSUE_STORE_DIR"))
+            issue_stores.set(key, store)
+        return store
+
+
 def get_open_activity_count(owner: str, repo: str, spark_path: str, token: Optional[str]) -> Dict[str, Any]:
     headers = build_github_headers_with_token(token)
     
@@ -143,51 +1588,23 @@ def get_open_activity_count(owner: str, repo: str, spark_path: str, token: Optio
         except Exception:
             can_push = False
 
-    # 1. Fetch Pull Requests
-    pulls_url = f"https://api.github.com/repos/{owner}/{repo}/pulls?state=open&per_page=100"
-    pulls = fetch_json(pulls_url, headers)
-
-    count = 0
-    items: List[Dict[str, Any]] = []
-
-    for pr in pulls:
-        number = pr.get("number")
-        if not number:
-            continue
-        files_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{number}/files?per_page=100"
-        files = fetch_json(files_url, headers)
-        for item in files:
-            if item.get("filename") == spark_path:
-                count += 1
-                items.append({
-                    "type": "pr",
-                    "url": pr.get("html_url"),
-                    "number": pr.get("number"),
-                    "user": (pr.get("user") or {}).get("login"),
-                })
-                break
-
-    # 2. Fetch Issues (Proposals)
-    issues_url = f"https://api.github.com/repos/{owner}/{repo}/issues?state=open&per_page=100"
-    all_issues = fetch_json(issues_url, headers)
-    
-    # Filter for proposals that aren't PRs and mention the spark_path
-    spark_name = spark_path.split("/")[-1].replace(".spark.md", "")
-    for issue in all_issues:
-        if issue.get("pull_request"):
-            continue
-
-        title = issue.get("title", "").lower()
-        body = issue.get("body", "").lower() if issue.get("body") else ""
-
-        if spark_name.lower() in title or spark_name.lower() in body:
-            count += 1
-            items.append({
-                "type": "issue",
-                "url": issue.get("html_url"),
-                "number": issue.get("number"),
-                "user": (issue.get("user") or {}).get("login"),
-            })
+    # 1. Look up open Pull Requests touching this file in the shared index
+    pr_index = get_pr_index(owner, repo)
+    pr_index.ensure_fresh(headers, get_cache_ttl_ms())
+    items: List[Dict[str, Any]] = pr_index.lookup(spark_path)
+    count = len(items)
+
+    # 2. Open issues (proposals) mentioning the spark, from the issue store
+    issue_store = get_issue_store(owner, repo)
+    issue_store.ensure_fresh(headers, get_cache_ttl_ms())
+    for issue in issue_store.mentions(spark_name_from_path(spark_path), state="open"):
+        count += 1
+        items.append({
+            "type": "issue",
+            "url": issue["html_url"],
+            "number": issue["number"],
+            "user": issue["user"].get("login"),
+        })
 
     return {"count": count, "items": items, "can_push": can_push}
 
@@ -239,25 +1656,121 @@ def get_last_commit_author(owner: str, repo: str, path: str, branch: str, header
     return None
 
 
-def get_file_commit_history(owner: str, repo: str, path: str, branch: str, headers: Dict[str, str]) -> List[Dict[str, Any]]:
+def fetch_graphql(query: str, variables: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    """POST a GraphQL query to GitHub and return its data block."""
+    request_headers = {**headers, "Content-Type": "application/json"}
+    body = json.dumps({"query": query, "variables": variables}).encode("utf-8")
+    response = http_pool.request("POST", "https://api.github.com/graphql", request_headers, body)
+    result = json.loads(response.text())
+    if result.get("errors") and not result.get("data"):
+        raise RuntimeError(f"GraphQL error: {result['errors'][0].get('message')}")
+    return result.get("data") or {}
+
+
+def get_graphql_batch_size() -> int:
+    return max(1, int(get_env("GITHUB_GRAPHQL_BATCH_SIZE", "50")))
+
+
+def get_last_commit_authors(
+    owner: str,
+    repo: str,
+    paths: List[str],
+    branch: str,
+    headers: Dict[str, str],
+) -> Dict[str, Optional[Dict[str, Optional[str]]]]:
+    """Fetch last-commit author info for many files at once.
+
+    Paths are resolved in chunks of GITHUB_GRAPHQL_BATCH_SIZE, each chunk
+    being a single GraphQL query with one aliased history(path:, first: 1)
+    field per path. GraphQL requires authentication, so without a token, or
+    when a chunk fails, the per-path REST lookup (get_last_commit_author)
+    is used instead. Returns a mapping of path to the same shape that
+    get_last_commit_author returns.
+    """
+    def rest_fallback(chunk: List[str]) -> Dict[str, Optional[Dict[str, Optional[str]]]]:
+        results = run_bounded(lambda path: get_last_commit_author(owner, repo, path, branch, headers), chunk)
+        return dict(zip(chunk, results))
+
+    if not paths:
+        return {}
+    if not headers.get("Authorization"):
+        return rest_fallback(paths)
+
+    def resolve_chunk(chunk: List[str]) -> Dict[str, Optional[Dict[str, Optional[str]]]]:
+        path_vars = ", ".join(f"$p{i}: String!" for i in range(len(chunk)))
+        fields = "\n".join(
+            f"f{i}: history(path: $p{i}, first: 1) {{ nodes {{ author {{ name date user {{ login }} }} }} }}"
+            for i in range(len(chunk))
+        )
+        query = (
+            f"query($owner: String!, $name: String!, $expression: String!, {path_vars}) {{\n"
+            "  repository(owner: $owner, name: $name) {\n"
+            "    object(expression: $expression) {\n"
+            f"      ... on Commit {{\n{fields}\n      }}\n"
+            "    }\n"
+            "  }\n"
+            "}"
+        )
+        variables: Dict[str, Any] = {"owner": owner, "name": repo, "expression": branch}
+        variables.update({f"p{i}": path for i, path in enumerate(chunk)})
+        try:
+            data = fetch_graphql(query, variables, headers)
+            commit = (data.get("repository") or {}).get("object")
+            if not commit:
+                raise RuntimeError(f"branch '{branch}' not found")
+        except Exception as err:
+            print(f"GraphQL commit lookup failed for {owner}/{repo}, using REST: {err}")
+            return rest_fallback(chunk)
+
+        resolved: Dict[str, Optional[Dict[str, Optional[str]]]] = {}
+        for i, path in enumerate(chunk):
+            nodes = (commit.get(f"f{i}") or {}).get("nodes") or []
+            author = (nodes[0].get("author") or {}) if nodes else {}
+            result: Dict[str, Optional[str]] = {}
+            login = (author.get("user") or {}).get("login")
+            if login:
+                result["login"] = login
+            if author.get("name"):
+                result["name"] = author["name"]
+            if author.get("date"):
+                result["date"] = author["date"]
+            resolved[path] = result or None
+        return resolved
+
+    batch_size = get_graphql_batch_size()
+    chunks = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    authors: Dict[str, Optional[Dict[str, Optional[str]]]] = {}
+    for chunk_result in run_bounded(resolve_chunk, chunks):
+        authors.update(chunk_result)
+    return authors
+
+
+def get_file_commit_history(
+    owner: str,
+    repo: str,
+    path: str,
+    branch: str,
+    headers: Dict[str, str],
+    limit: Optional[int] = 50,
+) -> List[Dict[str, Any]]:
     """Fetch commit history for a given file.
 
     Returns a list of commits (most recent first) using the GitHub commits API
-    filtered by path and branch.
+    filtered by path and branch, following pagination until limit commits
+    have been read (or the history is exhausted when limit is None).
     """
+    per_page = min(limit, 100) if limit else 100
     commits_url = (
         f"https://api.github.com/repos/{owner}/{repo}/commits"
-        f"?path={urllib.parse.quote(path)}&sha={urllib.parse.quote(branch)}&per_page=50"
+        f"?path={urllib.parse.quote(path)}&sha={urllib.parse.quote(branch)}&per_page={per_page}"
     )
+    commits: List[Dict[str, Any]] = []
     try:
-        commits = fetch_json(commits_url, headers)
+        for commit in iter_github_list(commits_url, headers, max_items=limit):
+            commits.append(commit)
     except Exception as err:
-        print(f"Failed to fetch commit history for {path}: {err}")
-        return []
-
-    if isinstance(commits, list):
-        return commits
-    return []
+        print(f"Failed to fetch commit history for {path} after {len(commits)} commits: {err}")
+    return commits
 
 
 def fetch_single_spark(owner: str, repo: str, path: str, branch: str = "main") -> Dict[str, Any]:
@@ -290,14 +1803,86 @@ def fetch_single_spark(owner: str, repo: str, path: str, branch: str = "main") -
     }
 
 
+def get_fetch_concurrency() -> int:
+    return max(1, int(get_env("SPARK_FETCH_CONCURRENCY", "8")))
+
+
+def run_bounded(func, items: List[Any], max_workers: Optional[int] = None) -> List[Any]:
+    """Apply func to every item with at most max_workers calls in flight.
+
+    Results are returned in the same order as items. Exceptions are not
+    swallowed here; callers handle per-item failures inside func.
+    """
+    if not items:
+        return []
+    workers = min(max_workers or get_fetch_concurrency(), len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    # Worker threads inherit the caller's context (e.g. its GitHub priority).
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="spark-fetch") as pool:
+        return list(pool.map(lambda item: context.copy().run(func, item), items))
+
+
+def discover_spark_files_from_tree(owner: str, repo: str, branch: str) -> List[Dict[str, Any]]:
+    """List *.spark.md blobs from the branch's recursive git tree.
+
+    A single API call returns every path in the repository together with
+    its blob SHA. Like code search it covers the whole repository, since
+    spark_cache keys listings by repo and branch only. Raises RuntimeError
+    when GitHub truncates the tree so the caller can fall back to another
+    discovery method.
+    """
+    headers = build_github_headers()
+    tree_url = (
+        f"https://api.github.com/repos/{owner}/{repo}/git/trees/"
+        f"{urllib.parse.quote(branch, safe='')}?recursive=1"
+    )
+    tree = fetch_json(tree_url, headers)
+    if tree.get("truncated"):
+        raise RuntimeError(f"Git tree for {owner}/{repo}@{branch} is truncated")
+
+    items = []
+    for entry in tree.get("tree", []):
+        path = entry.get("path") or ""
+        if entry.get("type") != "blob" or not path.endswith(".spark.md"):
+            continue
+        items.append({
+            "name": path.split("/")[-1],
+            "path": path,
+            "sha": entry.get("sha"),
+            "blob_url": entry.get("url"),
+        })
+    return items
+
+
+def fetch_blob_text(blob_url: str, headers: Dict[str, str]) -> str:
+    """Download a git blob's raw content. Blobs are immutable, so no revalidation is needed."""
+    response = http_pool.request("GET", blob_url, {**headers, "Accept": "application/vnd.github.raw"})
+    return response.text()
+
+
 def fetch_sparks_from_github(owner: str, repo: str, branch: str = "main", search_path: str = "sparks") -> Dict[str, Any]:
+    # A full crawl yields to interactive single-spark reads for rate-limit budget.
+    with github_priority("crawl"):
+        return _fetch_sparks_from_github(owner, repo, branch, search_path)
+
+
+def _fetch_sparks_from_github(owner: str, repo: str, branch: str, search_path: str) -> Dict[str, Any]:
     headers = build_github_headers()
     spark_items: List[Dict[str, Any]] = []
 
-    try:
-        spark_items = search_for_spark_files(owner, repo)
-    except Exception as err:
-        print(f"Search failed, falling back to directory listing: {err}")
+    if get_env("SPARK_DISCOVERY_MODE", "tree") == "tree":
+        try:
+            spark_items = discover_spark_files_from_tree(owner, repo, branch)
+        except Exception as err:
+            print(f"Tree discovery failed, falling back to code search: {err}")
+
+    if not spark_items:
+        try:
+            spark_items = search_for_spark_files(owner, repo)
+        except Exception as err:
+            print(f"Search failed, falling back to directory listing: {err}")
 
     if not spark_items:
         index_url = f"https://api.github.com/repos/{owner}/{repo}/contents/{search_path}?ref={branch}"
@@ -317,26 +1902,61 @@ def fetch_sparks_from_github(owner: str, repo: str, branch: str = "main", search
             if item.get("type") == "file" and item.get("name", "").endswith(".spark.md")
         ]
 
-    files = []
-    for item in spark_items:
+    def fetch_item(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         try:
             path = item.get("path") or item.get("name")
             if not path:
-                continue
-            content_url = item.get("download_url")
-            if not content_url:
-                content_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
-            content = fetch_text(content_url, headers)
-            last_commit_author = get_last_commit_author(owner, repo, path, branch, headers)
-            files.append({
+                return None
+            # Content is addressed by blob SHA, so unchanged sparks are served
+            # from blob_cache and only new or modified blobs are downloaded.
+            sha = item.get("sha")
+            content = blob_cache.get(sha) if sha else None
+            if content is None:
+                if item.get("blob_url"):
+                    content = fetch_blob_text(item["blob_url"], headers)
+                else:
+                    content_url = item.get("download_url")
+                    if not content_url:
+                        content_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
+                    content = fetch_text(content_url, headers)
+                if sha:
+                    blob_cache.set(sha, content)
+            return {
                 "name": item.get("name") or path.split("/")[-1],
                 "path": path,
+                "sha": sha,
                 "content": content,
-                "lastCommit": last_commit_author,
-            })
+                "lastCommit": None,
+            }
         except Exception as err:
             print(f"Failed to fetch {item.get('name') or item.get('path')}: {err}")
-            continue
+            return None
+
+    # Contents are fetched concurrently; map() yields results in input order
+    # so the file listing stays deterministic. Commit metadata is reused for
+    # files whose blob is unchanged and resolved in a few batched queries for
+    # the rest.
+    files = [file for file in run_bounded(fetch_item, spark_items) if file]
+
+    def commit_key(file: Dict[str, Any]) -> Optional[str]:
+        return f"{owner}/{repo}:{branch}:{file['path']}@{file['sha']}" if file.get("sha") else None
+
+    missing = []
+    for file in files:
+        key = commit_key(file)
+        cached_commit = last_commit_cache.get(key) if key else None
+        if cached_commit is not None:
+            file["lastCommit"] = cached_commit or None
+        else:
+            missing.append(file)
+
+    authors = get_last_commit_authors(owner, repo, [file["path"] for file in missing], branch, headers)
+    for file in missing:
+        file["lastCommit"] = authors.get(file["path"])
+        key = commit_key(file)
+        if key:
+            # Store {} for "no author found" so it is not looked up again.
+            last_commit_cache.set(key, file["lastCommit"] or {})
 
     return {
         "source": "github",
@@ -347,8 +1967,744 @@ def fetch_sparks_from_github(owner: str, repo: str, branch: str = "main", search
     }
 
 
+def git_blob_sha(content: str) -> str:
+    """The SHA git assigns to a blob with this content."""
+    data = content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
 def get_cache_ttl_ms() -> int:
-    return int(get_env("SPARK_CACHE_TTL_SECONDS", "60")) * 1000
+    # With webhooks configured, pushes update caches directly and the TTL is
+    # only a safety net, so it defaults to an hour instead of a minute.
+    default = "3600" if os.environ.get("GITHUB_WEBHOOK_SECRET") else "60"
+    return int(get_env("SPARK_CACHE_TTL_SECONDS", default)) * 1000
+
+
+def load_sparks_into_cache(cache_key: str, owner: str, repo: str, branch: str, search_path: str) -> Tuple[int, Dict[str, Any]]:
+    """Crawl a repository's sparks and store the listing in spark_cache.
+
+    Concurrent loads of the same key (cold requests, background refreshes)
+    share a single crawl. Returns (stored_at_ms, data).
+    """
+    return single_flight.do(
+        "repo_crawl",
+        f"{cache_key}:{search_path}",
+        lambda: _load_sparks_into_cache(cache_key, owner, repo, branch, search_path),
+    )
+
+
+def _load_sparks_into_cache(cache_key: str, owner: str, repo: str, branch: str, search_path: str) -> Tuple[int, Dict[str, Any]]:
+    data = fetch_sparks_from_github(owner, repo, branch, search_path)
+    stored_at = int(time.time() * 1000)
+    spark_cache.set(cache_key, {**data, "cacheKey": cache_key}, stored_at=stored_at)
+    sync_search_indexes(cache_key, data["files"], stored_at)
+    get_issue_store(owner, repo).register_names([spark_name_from_path(f["path"]) for f in data["files"]])
+    return stored_at, data
+
+
+def refresh_sparks_in_background(cache_key: str, owner: str, repo: str, branch: str, search_path: str) -> bool:
+    """Start a background re-crawl for cache_key unless one is already running.
+
+    Returns True when a new refresh was started. Failures keep the stale
+    entry in place so readers continue to get the last good listing.
+    """
+    with _spark_refreshes_lock:
+        if cache_key in _spark_refreshes:
+            return False
+        _spark_refreshes.add(cache_key)
+
+    # With a shared cache, only one worker process re-crawls a given key.
+    lease = f"spark-refresh:{cache_key}"
+    if shared_cache_backend is not None:
+        try:
+            acquired = shared_cache_backend.acquire_lease(lease, 300)
+        except sqlite3.Error:
+            acquired = True
+        if not acquired:
+            with _spark_refreshes_lock:
+                _spark_refreshes.discard(cache_key)
+            return False
+
+    def refresh() -> None:
+        try:
+            with github_priority("background"):
+                load_sparks_into_cache(cache_key, owner, repo, branch, search_path)
+        except Exception as err:
+            print(f"Background refresh failed for {cache_key}: {err}")
+        finally:
+            if shared_cache_backend is not None:
+                try:
+                    shared_cache_backend.release_lease(lease)
+                except sqlite3.Error:
+                    pass
+            with _spark_refreshes_lock:
+                _spark_refreshes.discard(cache_key)
+
+    threading.Thread(target=refresh, name=f"spark-refresh:{cache_key}", daemon=True).start()
+    return True
+
+
+def warmup_targets() -> List[Tuple[str, str, str]]:
+    """(owner, repo, branch) for each repo in SPARK_WARMUP_REPOS.
+
+    Entries are comma separated as owner/repo or owner/repo@branch; the
+    default is SPARK_REPO on main.
+    """
+    targets = []
+    raw = get_env("SPARK_WARMUP_REPOS", "") or get_env("SPARK_REPO", "rvishravars/primer")
+    for item in raw.split(","):
+        repo_input, _, branch = item.strip().partition("@")
+        if not repo_input:
+            continue
+        try:
+            parsed = parse_repo_url(repo_input)
+        except ValueError as err:
+            print(f"Skipping warm-up of '{item.strip()}': {err}")
+            continue
+        targets.append((parsed["owner"], parsed["repo"], branch or "main"))
+    return targets
+
+
+class RepoWarmer:
+    """Prefetches the configured repositories and keeps them hot.
+
+    On start a background thread crawls each repo's spark listing (which
+    also builds its search indexes and last-commit metadata) and loads its
+    pull request index and issue store; the process reports ready once every
+    repo has been tried. Afterwards it re-crawls listings before they expire
+    and refreshes the PR and issue indexes every interval_seconds, all at
+    background GitHub priority.
+    """
+
+    def __init__(self, targets: List[Tuple[str, str, str]], interval_seconds: float):
+        self.targets = targets
+        self.interval_seconds = interval_seconds
+        self.ready = threading.Event()
+        self.status: Dict[str, Dict[str, Any]] = {}
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="repo-warmer", daemon=True).start()
+
+    def _set_status(self, key: str, **fields: Any) -> None:
+        with self._lock:
+            self.status[key] = {**self.status.get(key, {}), **fields}
+
+    def _load_listing(self, cache_key: str, owner: str, repo: str, branch: str) -> None:
+        # Worker processes starting together share one crawl: whoever holds
+        # the refresh lease crawls, the rest wait for its listing to appear.
+        lease = f"spark-refresh:{cache_key}"
+        deadline = time.time() + 300
+        while True:
+            entry = spark_cache.get_entry(cache_key)
+            if entry and int(time.time() * 1000) - entry[0] < get_cache_ttl_ms():
+                return
+            try:
+                acquired = shared_cache_backend is None or shared_cache_backend.acquire_lease(lease, 300)
+            except sqlite3.Error:
+                acquired = True
+            if acquired or time.time() > deadline:
+                break
+            time.sleep(1)
+        try:
+            load_sparks_into_cache(cache_key, owner, repo, branch, "")
+        finally:
+            if shared_cache_backend is not None and acquired:
+                try:
+                    shared_cache_backend.release_lease(lease)
+                except sqlite3.Error:
+                    pass
+
+    def _warm(self, owner: str, repo: str, branch: str) -> None:
+        cache_key = f"{owner}/{repo}:{branch}"
+        started = time.time()
+        try:
+            with github_priority("crawl"):
+                self._load_listing(cache_key, owner, repo, branch)
+                headers = build_github_headers()
+                get_pr_index(owner, repo).ensure_fresh(headers, get_cache_ttl_ms())
+                get_issue_store(owner, repo).ensure_fresh(headers, get_cache_ttl_ms())
+        except Exception as err:
+            print(f"Warm-up failed for {cache_key}: {err}")
+            self._set_status(cache_key, warmed=False, error=str(err))
+            return
+        took_ms = int((time.time() - started) * 1000)
+        print(f"Warmed {cache_key} in {took_ms} ms")
+        self._set_status(cache_key, warmed=True, error=None, took_ms=took_ms, warmed_at=int(time.time() * 1000))
+
+    def _keep_hot(self, owner: str, repo: str, branch: str) -> None:
+        cache_key = f"{owner}/{repo}:{branch}"
+        entry = spark_cache.get_entry(cache_key)
+        # Re-crawl when the listing would expire before the next pass.
+        if entry is None or int(time.time() * 1000) - entry[0] >= get_cache_ttl_ms() - self.interval_seconds * 1000:
+            refresh_sparks_in_background(cache_key, owner, repo, branch, "")
+        try:
+            with github_priority("background"):
+                headers = build_github_headers()
+                get_pr_index(owner, repo).ensure_fresh(headers, get_cache_ttl_ms())
+                get_issue_store(owner, repo).ensure_fresh(headers, get_cache_ttl_ms())
+        except Exception as err:
+            print(f"Background refresh of {cache_key} indexes failed: {err}")
+            return
+        self._set_status(cache_key, refreshed_at=int(time.time() * 1000))
+
+    def _run(self) -> None:
+        for owner, repo, branch in self.targets:
+            self._warm(owner, repo, branch)
+        self.ready.set()
+        if self.interval_seconds <= 0:
+            return
+        while True:
+            time.sleep(self.interval_seconds)
+            for owner, repo, branch in self.targets:
+                self._keep_hot(owner, repo, branch)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            repos = {key: dict(status) for key, status in self.status.items()}
+        return {
+            "ready": self.ready.is_set(),
+            "started": self._started,
+            "interval_seconds": self.interval_seconds,
+            "repos": repos,
+        }
+
+
+repo_warmer = RepoWarmer(warmup_targets(), float(os.environ.get("SPARK_REFRESH_INTERVAL_SECONDS", "30")))
+
+
+def start_warmup() -> None:
+    """Start warming the configured repos, unless SPARK_WARMUP is disabled."""
+    if get_env("SPARK_WARMUP", "true").lower() in ("0", "false", "no"):
+        repo_warmer.ready.set()
+        return
+    repo_warmer.start()
+
+
+SEARCH_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how if in into is it its not of on or "
+    "that the their then there these this to was we what when which will with".split()
+)
+MARKDOWN_HEADING = re.compile(r"^#{1,6}\s+(.*?)\s*#*\s*$")
+
+
+def tokenize_for_search(text: str) -> List[str]:
+    return [
+        token for token in SEARCH_TOKEN_PATTERN.findall(text.lower())
+        if len(token) > 1 and token not in SEARCH_STOPWORDS
+    ]
+
+
+def chunk_spark_by_section(content: str) -> List[Tuple[str, str]]:
+    """Split spark markdown into (section title, text) chunks.
+
+    YAML frontmatter becomes its own "frontmatter" chunk and every markdown
+    heading (outside code fences) starts a new chunk.
+    """
+    chunks: List[Tuple[str, str]] = []
+    body = content
+    if content.startswith("---"):
+        end = content.find("\n---", 3)
+        if end != -1:
+            chunks.append(("frontmatter", content[3:end].strip()))
+            body = content[end + 4:]
+
+    title = "Introduction"
+    lines: List[str] = []
+    in_fence = False
+    for line in body.splitlines():
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        heading = None if in_fence else MARKDOWN_HEADING.match(line)
+        if heading:
+            if "\n".join(lines).strip():
+                chunks.append((title, "\n".join(lines).strip()))
+            title = heading.group(1) or title
+            lines = [line]
+        else:
+            lines.append(line)
+    if "\n".join(lines).strip():
+        chunks.append((title, "\n".join(lines).strip()))
+    return [(section, text) for section, text in chunks if text]
+
+
+class BM25Index:
+    """In-process BM25 index over the sections of a repository's sparks.
+
+    Sparks are chunked by section and added to an inverted index. update()
+    re-indexes a spark only when its content hash changed, so keeping the
+    index in sync with a refreshed listing touches just the edited sparks.
+    """
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self) -> None:
+        self._chunks: Dict[str, Dict[str, Any]] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._sparks: Dict[str, Tuple[str, List[str]]] = {}
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._sparks)
+
+    def _remove(self, path: str) -> None:
+        _, chunk_ids = self._sparks.pop(path, ("", []))
+        for chunk_id in chunk_ids:
+            chunk = self._chunks.pop(chunk_id)
+            self._total_length -= chunk["length"]
+            for term in chunk["terms"]:
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(chunk_id, None)
+                    if not postings:
+                        del self._postings[term]
+
+    def update(self, path: str, content: str) -> bool:
+        """(Re)index one spark; returns False when its content is unchanged."""
+        content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        with self._lock:
+            if self._sparks.get(path, ("",))[0] == content_hash:
+                return False
+            self._remove(path)
+            chunk_ids = []
+            for i, (section, text) in enumerate(chunk_spark_by_section(content)):
+                chunk_id = f"{path}#{i}"
+                terms = Counter(tokenize_for_search(f"{section}\n{text}"))
+                length = sum(terms.values())
+                self._chunks[chunk_id] = {
+                    "path": path,
+                    "section": section,
+                    "text": text,
+                    "length": length,
+                    "terms": list(terms),
+                }
+                self._total_length += length
+                for term, freq in terms.items():
+                    self._postings.setdefault(term, {})[chunk_id] = freq
+                chunk_ids.append(chunk_id)
+            self._sparks[path] = (content_hash, chunk_ids)
+            return True
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            self._remove(path)
+
+    def sync(self, files: List[Dict[str, Any]]) -> int:
+        """Make the index match a spark listing; returns how many sparks changed."""
+        changed = 0
+        with self._lock:
+            present = set()
+            for file in files:
+                if not file.get("path"):
+                    continue
+                present.add(file["path"])
+                changed += self.update(file["path"], file.get("content") or "")
+            for path in list(self._sparks):
+                if path not in present:
+                    self._remove(path)
+                    changed += 1
+        return changed
+
+    def search(self, query: str, k: int = 5, exclude_path: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the top-k chunks for query ranked by BM25 score."""
+        query_terms = Counter(tokenize_for_search(query))
+        # Long queries (e.g. a whole spark) are reduced to their most frequent terms.
+        terms = [term for term, _ in query_terms.most_common(64)]
+        with self._lock:
+            total_chunks = len(self._chunks)
+            if not total_chunks or not terms:
+                return []
+            avg_length = self._total_length / total_chunks or 1.0
+            scores: Dict[str, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, freq in postings.items():
+                    length = self._chunks[chunk_id]["length"]
+                    norm = freq * (self.k1 + 1) / (freq + self.k1 * (1 - self.b + self.b * length / avg_length))
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * norm
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            results = []
+            for chunk_id, score in ranked:
+                chunk = self._chunks[chunk_id]
+                if exclude_path and chunk["path"] == exclude_path:
+                    continue
+                results.append({
+                    "path": chunk["path"],
+                    "section": chunk["section"],
+                    "text": chunk["text"],
+                    "score": round(score, 4),
+                })
+                if len(results) >= k:
+                    break
+            return results
+
+
+def hashing_embedding(text: str, dim: int) -> Any:
+    """Embed text offline with the hashing trick.
+
+    Unigrams and bigrams are hashed into dim signed buckets with
+    log-scaled counts, then L2-normalised so a dot product is the cosine
+    similarity. No model download or network access is needed.
+    """
+    tokens = tokenize_for_search(text)
+    features = Counter(tokens)
+    features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, count in features.items():
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dim
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[bucket] += sign * (1.0 + math.log(count))
+    norm = float(np.linalg.norm(vector))
+    if norm:
+        vector /= norm
+    return vector
+
+
+# Local embedding functions by name, selected with SPARK_EMBEDDING_MODEL.
+# Each takes (text, dim) and returns a normalised float32 vector.
+EMBEDDERS: Dict[str, Callable[[str, int], Any]] = {
+    "hashing": hashing_embedding,
+}
+
+
+class EmbeddingStore:
+    """Content-addressed chunk embeddings, persisted as a float32 matrix.
+
+    Vectors are keyed by a hash of the chunk text and the embedder, so a
+    chunk is embedded once no matter how many refreshes see it. With a
+    directory, new rows are appended to embeddings.f32 and their keys and
+    row numbers to keys.jsonl, and the matrix is memory-mapped, so restarts
+    reuse earlier embeddings instead of recomputing them. Worker processes
+    can share the directory: appends happen under an exclusive file lock,
+    row numbers come from the matrix file's length, and each process picks
+    up the rows the others appended before embedding anything itself.
+    """
+
+    def __init__(self, embedder_name: str, dim: int, directory: Optional[str]):
+        self.embedder_name = embedder_name
+        self.embed = EMBEDDERS[embedder_name]
+        self.dim = dim
+        self.directory = Path(directory) / f"{embedder_name}-{dim}" if directory else None
+        self._rows: Dict[str, int] = {}
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._keys_offset = 0
+        self._lock = threading.Lock()
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            try:
+                with self._file_lock():
+                    self._sync()
+            except OSError as err:
+                print(f"Ignoring unreadable embedding store in {self.directory}: {err}")
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        with open(self.directory / "lock", "a") as handle:
+            if FCNTL_AVAILABLE:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if FCNTL_AVAILABLE:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _row_count(self) -> int:
+        """Whole rows in the matrix file, dropping a partially written tail."""
+        matrix_path = self.directory / "embeddings.f32"
+        if not matrix_path.exists():
+            return 0
+        size = matrix_path.stat().st_size
+        rows = size // (4 * self.dim)
+        if size != rows * 4 * self.dim:
+            os.truncate(matrix_path, rows * 4 * self.dim)
+        return rows
+
+    def _sync(self) -> None:
+        """Adopt rows appended since the last sync (caller holds the file lock)."""
+        keys_path = self.directory / "keys.jsonl"
+        matrix_path = self.directory / "embeddings.f32"
+        if not keys_path.exists() and matrix_path.exists():
+            # Rows without a keys file (an older single-writer layout) cannot
+            # be trusted; start the matrix over.
+            os.truncate(matrix_path, 0)
+            (self.directory / "keys.json").unlink(missing_ok=True)
+        rows = self._row_count()
+        if keys_path.exists():
+            with open(keys_path, "rb") as handle:
+                handle.seek(self._keys_offset)
+                data = handle.read()
+            # Only complete lines; a torn last line is left for a later sync.
+            complete = data[:data.rfind(b"\n") + 1]
+            self._keys_offset += len(complete)
+            for line in complete.splitlines():
+                try:
+                    key, row = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(row, int) and 0 <= row < rows:
+                    self._rows.setdefault(key, row)
+        if rows:
+            self._matrix = np.memmap(matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+
+    def _append(self, keys: List[str], vectors: Any) -> None:
+        """Append rows for keys (caller holds the file lock and has synced)."""
+        base = self._row_count()
+        with open(self.directory / "embeddings.f32", "ab") as handle:
+            handle.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        # Vectors are written before their keys, so a key never points past
+        # the end of the matrix even if the process dies in between.
+        with open(self.directory / "keys.jsonl", "ab") as handle:
+            handle.write("".join(json.dumps([key, base + i]) + "\n" for i, key in enumerate(keys)).encode("utf-8"))
+        self._sync()
+
+    def key_for(self, text: str) -> str:
+        return hashlib.sha1(f"{self.embedder_name}:{self.dim}:{text}".encode("utf-8")).hexdigest()
+
+    def _add(self, keys: List[str], texts: List[str]) -> Dict[str, Any]:
+        """Embed and store the texts whose keys have no row yet.
+
+        Returns the vectors that could not be persisted; they are used for
+        this call only and recomputed next time.
+        """
+        new = {key: text for key, text in zip(keys, texts) if key not in self._rows}
+        if not new:
+            return {}
+        stacked = np.vstack([self.embed(text, self.dim) for text in new.values()]).astype(np.float32)
+        if self.directory:
+            try:
+                self._append(list(new), stacked)
+                return {}
+            except OSError as err:
+                print(f"Failed to persist embeddings: {err}")
+                return dict(zip(new, stacked))
+        base = len(self._matrix)
+        self._matrix = np.vstack([self._matrix, stacked])
+        self._rows.update({key: base + i for i, key in enumerate(new)})
+        return {}
+
+    def vectors(self, texts: List[str]) -> Any:
+        """Return a (len(texts), dim) matrix, embedding only unseen texts."""
+        keys = [self.key_for(text) for text in texts]
+        with self._lock:
+            unstored: Dict[str, Any] = {}
+            if any(key not in self._rows for key in keys):
+                if self.directory:
+                    try:
+                        with self._file_lock():
+                            self._sync()
+                            unstored = self._add(keys, texts)
+                    except OSError as err:
+                        print(f"Embedding store unavailable: {err}")
+                        unstored = {key: self.embed(text, self.dim) for key, text in zip(keys, texts) if key not in self._rows}
+                else:
+                    self._add(keys, texts)
+            if unstored:
+                return np.vstack([
+                    unstored[key] if key in unstored else np.asarray(self._matrix[self._rows[key]])
+                    for key in keys
+                ]).astype(np.float32)
+            rows = [self._rows[key] for key in keys]
+            return np.asarray(self._matrix[rows], dtype=np.float32) if rows else np.zeros((0, self.dim), dtype=np.float32)
+
+    def embed_query(self, text: str) -> Any:
+        return self.embed(text, self.dim)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "embedder": self.embedder_name,
+                "dim": self.dim,
+                "vectors": len(self._rows),
+                "persistent": self.directory is not None,
+            }
+
+
+_embedding_store: Optional[EmbeddingStore] = None
+_embedding_store_lock = threading.Lock()
+
+
+def get_embedding_store() -> EmbeddingStore:
+    global _embedding_store
+    with _embedding_store_lock:
+        if _embedding_store is None:
+            _embedding_store = EmbeddingStore(
+                get_env("SPARK_EMBEDDING_MODEL", "hashing"),
+                int(get_env("SPARK_EMBEDDING_DIM", "512")),
+                os.environ.get("SPARK_VECTOR_DIR"),
+            )
+        return _embedding_store
+
+
+class DenseVectorIndex:
+    """Cosine-similarity index over the section chunks of a repository's sparks.
+
+    Chunk vectors come from the shared EmbeddingStore and are held in one
+    contiguous float32 matrix, so a query is a single matrix-vector product
+    followed by a partial sort.
+    """
+
+    def __init__(self) -> None:
+        self._chunks: List[Dict[str, Any]] = []
+        self._matrix = None
+        self._hashes: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def sync(self, files: List[Dict[str, Any]]) -> int:
+        """Rebuild from a spark listing; unchanged chunks reuse stored vectors."""
+        hashes = {
+            file["path"]: hashlib.sha1((file.get("content") or "").encode("utf-8")).hexdigest()
+            for file in files if file.get("path")
+        }
+        with self._lock:
+            if hashes == self._hashes:
+                return 0
+            changed = sum(1 for path, digest in hashes.items() if self._hashes.get(path) != digest)
+            changed += sum(1 for path in self._hashes if path not in hashes)
+        chunks = [
+            {"path": file["path"], "section": section, "text": text}
+            for file in files if file.get("path")
+            for section, text in chunk_spark_by_section(file.get("content") or "")
+        ]
+        matrix = get_embedding_store().vectors([f"{c['section']}\n{c['text']}" for c in chunks])
+        with self._lock:
+            self._chunks = chunks
+            self._matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            self._hashes = hashes
+        return changed
+
+    def search(self, query: str, k: int = 5, exclude_path: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            chunks, matrix = self._chunks, self._matrix
+        if matrix is None or not len(chunks):
+            return []
+        scores = matrix @ get_embedding_store().embed_query(query)
+        if exclude_path:
+            scores = scores.copy()
+            scores[[i for i, chunk in enumerate(chunks) if chunk["path"] == exclude_path]] = -np.inf
+        top = min(k, len(chunks))
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        ordered = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [
+            {**chunks[i], "score": round(float(scores[i]), 4)}
+            for i in ordered if np.isfinite(scores[i]) and scores[i] > 0
+        ]
+
+
+RETRIEVERS: Dict[str, Callable[[], Any]] = {"bm25": BM25Index}
+if NUMPY_AVAILABLE:
+    RETRIEVERS["dense"] = DenseVectorIndex
+
+# Retrieval indexes keyed by "<retriever>:owner/repo:branch", kept in sync
+# with spark_cache.
+search_indexes = LRUCache(int(os.environ.get("SPARK_CACHE_MAX_ENTRIES", "32")) * len(RETRIEVERS))
+_search_indexes_lock = threading.Lock()
+
+
+def get_search_index(cache_key: str, retriever: str = "bm25") -> Any:
+    with _search_indexes_lock:
+        index = search_indexes.get(f"{retriever}:{cache_key}")
+        if index is None:
+            index = RETRIEVERS[retriever]()
+            search_indexes.set(f"{retriever}:{cache_key}", index)
+        return index
+
+
+def sync_search_indexes(cache_key: str, files: List[Dict[str, Any]], stored_at: int) -> None:
+    for retriever in RETRIEVERS:
+        try:
+            sync_search_index(get_search_index(cache_key, retriever), files, stored_at)
+        except Exception as err:  # noqa: BLE001
+            print(f"Failed to update {retriever} index for {cache_key}: {err}")
+
+
+def sync_search_index(index: Any, files: List[Dict[str, Any]], stored_at: int) -> None:
+    # synced_at records which spark listing the index reflects, so a listing
+    # stored by another worker is picked up on the next query.
+    index.sync(files)
+    index.synced_at = stored_at
+
+
+def retrieve_spark_snippets(
+    repo_input: str,
+    branch: str,
+    query: str,
+    k: int = 5,
+    exclude_path: Optional[str] = None,
+    build: bool = True,
+    retriever: str = "bm25",
+) -> List[Dict[str, Any]]:
+    """Top-k matches for query among the sparks of a repository.
+
+    retriever is "bm25" (lexical) or "dense" (local embeddings). When the
+    repository has not been indexed yet it is crawled first (via
+    spark_cache) if build is True; otherwise an empty list is returned
+    without any network call.
+    """
+    if retriever not in RETRIEVERS:
+        raise ValueError(f"Unknown or unavailable retriever '{retriever}'")
+    owner_repo = parse_repo_url(repo_input)
+    cache_key = f"{owner_repo['owner']}/{owner_repo['repo']}:{branch}"
+    index = get_search_index(cache_key, retriever)
+    entry = spark_cache.get_entry(cache_key)
+    if entry is not None and entry[0] != getattr(index, "synced_at", None):
+        sync_search_index(index, entry[1].get("files", []), entry[0])
+    elif entry is None and not len(index):
+        if build:
+            load_sparks_into_cache(cache_key, owner_repo["owner"], owner_repo["repo"], branch, "")
+        else:
+            return []
+    return index.search(query, k=k, exclude_path=exclude_path)
+
+
+def find_related_sparks(
+    repo_input: str,
+    branch: str,
+    query: str,
+    k: int,
+    exclude_path: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Sparks most similar to query by dense vectors, best section per spark.
+
+    Uses only data that is already indexed or cached; returns an empty
+    list rather than crawling GitHub.
+    """
+    try:
+        results = retrieve_spark_snippets(
+            repo_input, branch, query, k=k * 4, exclude_path=exclude_path, build=False, retriever="dense"
+        )
+    except Exception as err:  # noqa: BLE001
+        print(f"Related spark lookup failed: {err}")
+        return []
+    related: Dict[str, Dict[str, Any]] = {}
+    for result in results:
+        if result["path"] not in related:
+            related[result["path"]] = {
+                "path": result["path"],
+                "section": result["section"],
+                "score": result["score"],
+                "excerpt": result["text"][:400],
+            }
+    return list(related.values())[:k]
+
+
+def format_snippet(result: Dict[str, Any]) -> str:
+    return f"[{result['path']} § {result['section']}]\n{result['text']}"
 
 
 @app.get("/api/health")
@@ -356,29 +2712,365 @@ def health_check():
     return jsonify({"status": "ok"})
 
 
+@app.get("/api/ready")
+def readiness_check():
+    """Readiness probe: 503 until the warm-up pass over the configured repos is done."""
+    stats = repo_warmer.stats()
+    if not stats["ready"]:
+        return jsonify({"status": "warming", **stats}), 503
+    return jsonify({"status": "ready", **stats})
+
+
+@app.get("/api/metrics")
+def get_metrics():
+    """Operational counters for the GitHub connection pool and caches."""
+    with _conditional_stats_lock:
+        conditional = dict(conditional_stats)
+    with _webhook_stats_lock:
+        webhooks = dict(webhook_stats)
+    return jsonify({
+        "http_pool": http_pool.stats(),
+        "github_rate_limits": github_rate_limiter.stats(),
+        "single_flight": single_flight.stats(),
+        "conditional_requests": conditional,
+        "spark_cache": spark_cache.stats(),
+        "pr_indexes": pr_indexes.stats(),
+        "issue_stores": issue_stores.stats(),
+        "webhooks": webhooks,
+        "resilience": resilience_stats(),
+        "warmup": repo_warmer.stats(),
+        "blob_cache": blob_cache.stats(),
+        "llm_clients": llm_clients.stats(),
+        "search_indexes": search_indexes.stats(),
+        "embeddings": get_embedding_store().stats() if NUMPY_AVAILABLE else None,
+    })
+
+
+# SDK clients keep their own HTTP connection pools, so they are reused across
+# requests. Keys are provider plus a SHA-256 digest of the API key; the
+# plaintext key is never used as a registry key.
+llm_clients = LRUCache(int(os.environ.get("LLM_CLIENT_CACHE_MAX_ENTRIES", "64")))
+_llm_clients_lock = threading.Lock()
+
+
+def get_llm_client(provider: str, api_key: str, asynchronous: bool = False) -> Any:
+    """Return a shared OpenAI or Anthropic client for api_key.
+
+    Clients are created on first use and replaced after
+    LLM_CLIENT_TTL_SECONDS; the least recently used client is dropped when
+    the registry is full. asynchronous=True returns the SDK's async client
+    (used by the ASGI entrypoint). SDK retries are disabled; call_llm
+    retries behind the provider's circuit breaker instead.
+    """
+    kind = "async" if asynchronous else "sync"
+    registry_key = f"{provider}:{kind}:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()}"
+    ttl_ms = int(get_env("LLM_CLIENT_TTL_SECONDS", "900")) * 1000
+    with _llm_clients_lock:
+        client = llm_clients.get(registry_key, max_age_ms=ttl_ms)
+        if client is None:
+            if provider == "openai":
+                client = (openai.AsyncOpenAI if asynchronous else openai.OpenAI)(api_key=api_key, max_retries=0)
+            elif provider == "anthropic":
+                client = (anthropic.AsyncAnthropic if asynchronous else anthropic.Anthropic)(api_key=api_key, max_retries=0)
+            else:
+                raise ValueError(f"Unsupported provider '{provider}'")
+            llm_clients.set(registry_key, client)
+        return client
+
+
+class ResponseCache:
+    """Two-tier cache for model responses: in-memory LRU plus optional disk.
+
+    Disk entries are JSON files under directory, named by cache key, and
+    survive restarts. Entries older than ttl_seconds are ignored.
+    """
+
+    def __init__(self, max_entries: int, directory: Optional[str], ttl_seconds: int):
+        self.memory = LRUCache(max_entries)
+        self.directory = Path(directory) if directory else None
+        self.ttl_ms = ttl_seconds * 1000
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _disk_path(self, key: str) -> Optional[Path]:
+        return self.directory / f"{key}.json" if self.directory else None
+
+    def get(self, key: str) -> Any:
+        value = self.memory.get(key, max_age_ms=self.ttl_ms)
+        if value is not None:
+            return value
+        path = self._disk_path(key)
+        if not path or not path.exists():
+            return None
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if int(time.time() * 1000) - entry.get("stored_at", 0) >= self.ttl_ms:
+            return None
+        self.memory.set(key, entry["value"], stored_at=entry["stored_at"])
+        return entry["value"]
+
+    def set(self, key: str, value: Any) -> None:
+        stored_at = int(time.time() * 1000)
+        self.memory.set(key, value, stored_at=stored_at)
+        path = self._disk_path(key)
+        if not path:
+            return
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps({"stored_at": stored_at, "value": value}), encoding="utf-8")
+            os.replace(tmp_path, path)
+        except OSError as err:
+            print(f"Failed to persist model response cache entry: {err}")
+
+
+llm_response_cache = ResponseCache(
+    int(os.environ.get("LLM_RESPONSE_CACHE_MAX_ENTRIES", "256")),
+    os.environ.get("LLM_RESPONSE_CACHE_DIR"),
+    int(os.environ.get("LLM_RESPONSE_CACHE_TTL_SECONDS", "86400")),
+)
+
+
+def llm_response_cache_key(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_payload: Any,
+    temperature: float,
+) -> str:
+    """Stable hash identifying a model request for the response cache."""
+    material = json.dumps(
+        {
+            "provider": provider,
+            "model": model,
+            "system_prompt": system_prompt,
+            "user_payload": user_payload,
+            "temperature": temperature,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
 def estimate_tokens(text: str) -> int:
     """Very rough token estimate based on character count.
 
-    This is used for lightweight context window accounting in the
-    model gateway and orchestrator without depending on a tokenizer
-    library. Roughly assumes ~4 characters per token.
+    Used as the fallback for count_tokens when no tokenizer is available.
+    Roughly assumes ~4 characters per token.
     """
     if not text:
         return 0
     return max(1, len(text) // 4)
 
 
-@app.post("/api/model/infer")
-def model_infer():
-    """Generic model gateway endpoint.
+# Context windows (input + output tokens) by model name prefix; the longest
+# matching prefix wins.
+MODEL_CONTEXT_WINDOWS: Dict[str, int] = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o3": 200000,
+    "o4": 200000,
+    "claude": 200000,
+}
 
-    Accepts a structured payload and returns a single model response
-    string plus lightweight context accounting metadata.
+# Encodings loaded by load_tokenizers; the images pre-download them into
+# TIKTOKEN_CACHE_DIR, elsewhere tiktoken may fetch them over the network.
+TOKENIZER_ENCODINGS = ("o200k_base", "cl100k_base")
+_tokenizers: Dict[str, Any] = {}
+_tokenizers_lock = threading.Lock()
+_tokenizers_loading = False
+
+
+def load_tokenizers() -> None:
+    """Load the tiktoken encodings. Slow on first use without a cache."""
+    for name in TOKENIZER_ENCODINGS:
+        try:
+            encoding = tiktoken.get_encoding(name)
+        except Exception as err:  # noqa: BLE001
+            print(f"Tokenizer {name} unavailable, using character estimate: {err}")
+            encoding = None
+        with _tokenizers_lock:
+            _tokenizers[name] = encoding
+
+
+def start_tokenizer_loading() -> None:
+    """Load the encodings on a background thread, once per process."""
+    global _tokenizers_loading
+    if not TIKTOKEN_AVAILABLE:
+        return
+    with _tokenizers_lock:
+        if _tokenizers_loading:
+            return
+        _tokenizers_loading = True
+    threading.Thread(target=load_tokenizers, name="tokenizer-load", daemon=True).start()
+
+
+token_count_cache = LRUCache(int(os.environ.get("TOKEN_COUNT_CACHE_MAX_ENTRIES", "4096")))
+
+
+def get_tokenizer(model: str) -> Tuple[str, Any]:
+    """Return (name, encoding) of the offline tokenizer for a model family.
+
+    OpenAI models use their tiktoken encoding. Anthropic does not publish an
+    offline tokenizer for current Claude models, so cl100k_base is used as
+    the closest approximation. The encoding is None when tiktoken (or its
+    encoding files) is unavailable or still loading, in which case callers
+    fall back to estimate_tokens; a request never waits for a download.
+    """
+    if not TIKTOKEN_AVAILABLE:
+        return "heuristic", None
+    if model.startswith("claude"):
+        name = "cl100k_base"
+    else:
+        try:
+            name = tiktoken.encoding_name_for_model(model)
+        except (KeyError, AttributeError):
+            name = "o200k_base" if model.startswith(("gpt-4o", "gpt-4.1", "o1", "o3", "o4")) else "cl100k_base"
+    start_tokenizer_loading()
+    with _tokenizers_lock:
+        encoding = _tokenizers.get(name)
+    return (f"tiktoken:{name}" if encoding else "heuristic"), encoding
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Count tokens in text for model, caching counts per distinct text."""
+    if not text:
+        return 0
+    name, encoding = get_tokenizer(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    key = f"{name}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+    count = token_count_cache.get(key)
+    if count is None:
+        count = len(encoding.encode(text, disallowed_special=()))
+        token_count_cache.set(key, count)
+    return count
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """Cut text to at most max_tokens tokens for model."""
+    if max_tokens <= 0:
+        return ""
+    _, encoding = get_tokenizer(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def get_context_budget(model: str, max_output_tokens: int) -> int:
+    """Input-token budget for model: its window minus the reserved output,
+    capped by MODEL_CONTEXT_MAX_INPUT_TOKENS to bound cost per request."""
+    window = 8192
+    best = ""
+    for prefix, size in MODEL_CONTEXT_WINDOWS.items():
+        if model.startswith(prefix) and len(prefix) > len(best):
+            best, window = prefix, size
+    cap = int(get_env("MODEL_CONTEXT_MAX_INPUT_TOKENS", "16000"))
+    return max(0, min(window - max_output_tokens, cap))
+
+
+def pack_context(
+    model: str,
+    budget: int,
+    components: List[Tuple[str, List[str], str]],
+) -> Tuple[Dict[str, List[str]], Dict[str, int]]:
+    """Fit prompt components into a token budget in priority order.
+
+    components is a list of (name, items, mode), highest priority first:
+      - "required": always included, even past the budget
+      - "truncate": items included in order; the first that does not fit is
+        cut to the remaining budget and the rest dropped
+      - "prefix": items included in order until one does not fit
+      - "skip": items that do not fit are skipped, smaller later ones may fit
+    Returns (packed items per component, tokens used per component).
+    """
+    remaining = budget
+    packed: Dict[str, List[str]] = {}
+    usage: Dict[str, int] = {}
+    for name, items, mode in components:
+        included: List[str] = []
+        used = 0
+        for item in items:
+            if not item:
+                continue
+            tokens = count_tokens(item, model)
+            if mode == "required" or tokens <= remaining:
+                included.append(item)
+                used += tokens
+                remaining -= tokens
+                continue
+            if mode == "truncate" and remaining > 0:
+                cut = truncate_to_tokens(item, remaining, model)
+                included.append(cut)
+                tokens = count_tokens(cut, model)
+                used += tokens
+                remaining -= tokens
+            if mode in ("truncate", "prefix"):
+                break
+        packed[name] = included
+        usage[name] = used
+    return packed, usage
+
+
+def conversation_lines_newest_first(messages: List[Dict[str, Any]]) -> List[str]:
+    """Render chat turns as "Role: content" lines, most recent first."""
+    lines: List[str] = []
+    for m in reversed(messages):
+        role = (m.get("role") or "user").capitalize()
+        content = m.get("content") or ""
+        lines.append(f"{role}: {content}")
+    return lines
+
+
+def context_usage_report(model: str, budget: int, usage: Dict[str, int], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Per-component and total token usage of the prompt actually sent."""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        total += count_tokens(content, model)
+    return {
+        "tokenizer": get_tokenizer(model)[0],
+        "budget": budget,
+        "components": usage,
+        "total": total,
+    }
+
+
+class ApiError(Exception):
+    """A request that cannot be served, with the HTTP status to return."""
+
+    def __init__(self, message: str, status: int = 400, details: Optional[str] = None):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+    def to_dict(self) -> Dict[str, Any]:
+        body: Dict[str, Any] = {"error": str(self)}
+        if self.details:
+            body["details"] = self.details
+        return body
+
+
+def prepare_model_infer(payload: Dict[str, Any], asynchronous: bool = False) -> Dict[str, Any]:
+    """Validate a /api/model/infer request and pack its prompt.
+
+    Returns the prepared call (client, OpenAI request kwargs, token
+    accounting, response cache key). Raises ApiError for invalid requests.
     """
     if not OPENAI_AVAILABLE:
-        return jsonify({"error": "OpenAI SDK not installed on backend"}), 500
+        raise ApiError("OpenAI SDK not installed on backend", status=500)
 
-    payload = request.get_json(silent=True) or {}
     provider = payload.get("provider") or "openai"
     api_key = payload.get("apiKey") or os.environ.get("OPENAI_API_KEY")
     model = payload.get("model") or "gpt-4o-mini"
@@ -389,40 +3081,45 @@ def model_infer():
     task_type = payload.get("task_type") or "generic"
 
     if provider != "openai":
-        return jsonify({"error": "Only 'openai' provider is supported in Phase 1"}), 400
+        raise ApiError("Only 'openai' provider is supported in Phase 1")
 
     if not api_key:
-        return jsonify({"error": "OpenAI API key required"}), 400
+        raise ApiError("OpenAI API key required")
 
     try:
-        client = openai.OpenAI(api_key=api_key)
+        client = get_llm_client("openai", api_key, asynchronous)
     except TypeError as e:
-        return jsonify({
-            "error": "OpenAI client initialization failed. Ensure openai>=1.30.0 is installed.",
-            "details": str(e),
-        }), 500
-
-    # Assemble a compact context payload for the model
-    sections_text_parts = []
-    for key, value in (spark_sections or {}).items():
-        if not value:
-            continue
-        sections_text_parts.append(f"[Section {key}]\n{value}\n")
-    sections_text = "\n".join(sections_text_parts)
-
-    snippets_text = "\n\n".join(str(s) for s in retrieved_snippets if s)
+        raise ApiError(
+            "OpenAI client initialization failed. Ensure openai>=1.30.0 is installed.",
+            status=500,
+            details=str(e),
+        )
 
-    history_lines: List[str] = []
-    for m in conversation[-10:]:  # last 10 turns
-        role = (m.get("role") or "user").capitalize()
-        content = m.get("content") or ""
-        history_lines.append(f"{role}: {content}")
+    # Pack the context into the model's token budget by priority: system
+    # prompt and latest turn first, then spark sections, retrieved snippets
+    # and older history.
+    section_items = [
+        f"[Section {key}]\n{value}\n"
+        for key, value in (spark_sections or {}).items()
+        if value
+    ]
+    snippet_items = [str(s) for s in retrieved_snippets if s]
+    history_items = conversation_lines_newest_first(conversation)
+
+    budget = get_context_budget(model, 2000)
+    packed, usage = pack_context(model, budget, [
+        ("system_prompt", [system_prompt], "required"),
+        ("latest_turn", history_items[:1], "required"),
+        ("spark_sections", section_items, "truncate"),
+        ("retrieved_snippets", snippet_items, "skip"),
+        ("history", history_items[1:], "prefix"),
+    ])
 
     user_payload = {
       "task_type": task_type,
-      "sections": sections_text[:8000],
-      "retrieved": snippets_text[:4000],
-      "conversation": history_lines,
+      "sections": "\n".join(packed["spark_sections"]),
+      "retrieved": "\n\n".join(packed["retrieved_snippets"]),
+      "conversation": list(reversed(packed["latest_turn"] + packed["history"])),
     }
 
     messages = []
@@ -430,27 +3127,75 @@ def model_infer():
         messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": json.dumps(user_payload)})
 
-    # Lightweight context accounting
-    token_estimate = estimate_tokens(system_prompt) + estimate_tokens(sections_text) + estimate_tokens(snippets_text)
+    context_tokens = context_usage_report(model, budget, usage, messages)
+
+    # Responses are only cached for requests explicitly marked cacheable.
+    cache_key = None
+    if payload.get("cacheable") is True:
+        cache_key = llm_response_cache_key(provider, model, system_prompt, user_payload, 0.4)
 
+    return {
+        "provider": provider,
+        "model": model,
+        "task_type": task_type,
+        "client": client,
+        "request": {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.4,
+            "max_tokens": 2000,
+        },
+        "token_estimate": context_tokens["total"],
+        "context_tokens": context_tokens,
+        "cache_key": cache_key,
+    }
+
+
+def finalize_model_infer(run: Dict[str, Any], content: str, cache_status: Optional[str] = None) -> Dict[str, Any]:
+    """Build the /api/model/infer response body, caching fresh output."""
+    if cache_status is None:
+        cache_status = "miss" if run["cache_key"] else "bypass"
+    if cache_status == "miss":
+        llm_response_cache.set(run["cache_key"], content)
+    return {
+        "output": content,
+        "model": run["model"],
+        "provider": run["provider"],
+        "task_type": run["task_type"],
+        "estimated_tokens": run["token_estimate"],
+        "context": {
+            "estimated_tokens": run["token_estimate"],
+            "tokens": run["context_tokens"],
+            "response_cache": cache_status,
+        },
+    }
+
+
+@app.post("/api/model/infer")
+def model_infer():
+    """Generic model gateway endpoint.
+
+    Accepts a structured payload and returns a single model response
+    string plus lightweight context accounting metadata.
+    """
+    payload = request.get_json(silent=True) or {}
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.4,
-            max_tokens=2000,
-        )
+        run = prepare_model_infer(payload)
+    except ApiError as err:
+        return jsonify(err.to_dict()), err.status
+
+    content = llm_response_cache.get(run["cache_key"]) if run["cache_key"] else None
+    if content is not None:
+        return jsonify(finalize_model_infer(run, content, "hit"))
+
+    try:
+        response = call_llm("openai", "model_infer", lambda: run["client"].chat.completions.create(**run["request"]))
         content = (response.choices[0].message.content or "").strip()
+    except CircuitOpenError as err:
+        return jsonify({"error": str(err)}), 503
     except Exception as err:
         return jsonify({"error": f"OpenAI API error (model.infer): {err}"}), 502
-
-    return jsonify({
-        "output": content,
-        "model": model,
-        "provider": provider,
-        "task_type": task_type,
-        "estimated_tokens": token_estimate,
-    })
+    return jsonify(finalize_model_infer(run, content))
 
 
 @app.get("/api/sparks")
@@ -471,29 +3216,20 @@ def get_sparks():
     repo = parsed["repo"]
     cache_key = f"{owner}/{repo}:{branch}"
 
-    if cache["data"] and cache["data"].get("cacheKey") == cache_key:
-        if now - cache["timestamp"] < get_cache_ttl_ms():
-            cached_data = dict(cache["data"])
-            cached_data["cached"] = True
-            cached_data["updatedAt"] = cache["timestamp"]
-            return jsonify(cached_data)
+    entry = spark_cache.get_entry(cache_key)
+    if entry:
+        stored_at, cached_data = entry
+        if now - stored_at < get_cache_ttl_ms():
+            return jsonify({**cached_data, "cached": True, "updatedAt": stored_at})
+        # Stale-while-revalidate: answer immediately with the expired listing
+        # and let a single background refresh replace it.
+        refresh_sparks_in_background(cache_key, owner, repo, branch, search_path)
+        return jsonify({**cached_data, "cached": True, "stale": True, "revalidating": True, "updatedAt": stored_at})
 
     try:
-        data = fetch_sparks_from_github(owner, repo, branch, search_path)
-        cache["timestamp"] = now
-        cache["data"] = {**data, "cacheKey": cache_key}
-        response = {**data, "cached": False, "updatedAt": now}
-        return jsonify(response)
+        stored_at, data = load_sparks_into_cache(cache_key, owner, repo, branch, search_path)
+        return jsonify({**data, "cached": False, "updatedAt": stored_at})
     except RuntimeError as err:
-        if cache["data"] and cache["data"].get("cacheKey") == cache_key:
-            stale_data = dict(cache["data"])
-            stale_data.update({
-                "cached": True,
-                "stale": True,
-                "error": str(err),
-                "updatedAt": cache["timestamp"],
-            })
-            return jsonify(stale_data)
         return jsonify({"error": str(err), "files": []}), 502
 
 
@@ -520,7 +3256,11 @@ def get_spark():
     repo = parsed["repo"]
 
     try:
-        file_data = fetch_single_spark(owner, repo, path, branch)
+        file_data = single_flight.do(
+            "spark",
+            f"{owner}/{repo}:{branch}:{path}",
+            lambda: fetch_single_spark(owner, repo, path, branch),
+        )
         return jsonify({
             "owner": owner,
             "repo": repo,
@@ -528,6 +3268,12 @@ def get_spark():
             "file": file_data,
         })
     except Exception as err:
+        # GitHub unavailable: fall back to the copy in the cached listing.
+        listing = spark_cache.get(f"{owner}/{repo}:{branch}") or {}
+        stale = next((f for f in listing.get("files", []) if f.get("path") == path), None)
+        if stale:
+            count_resilience("stale_served", "spark")
+            return jsonify({"owner": owner, "repo": repo, "branch": branch, "file": stale, "stale": True})
         return jsonify({"error": str(err)}), 502
 
 
@@ -553,8 +3299,18 @@ def get_spark_history():
     repo = parsed["repo"]
     headers = build_github_headers_with_token(None)
 
+    # 50 most recent commits by default; ?limit=N reads more pages, ?limit=all
+    # the whole history.
+    limit_arg = request.args.get("limit") or "50"
     try:
-        commits = get_file_commit_history(owner, repo, path, branch, headers)
+        limit = None if limit_arg == "all" else int(limit_arg)
+    except ValueError:
+        return jsonify({"error": "limit must be a positive integer or 'all'"}), 400
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be a positive integer or 'all'"}), 400
+
+    try:
+        commits = get_file_commit_history(owner, repo, path, branch, headers, limit=limit)
         return jsonify({
             "owner": owner,
             "repo": repo,
@@ -570,42 +3326,207 @@ def get_spark_history():
 
 
 
-def generate_workbench_reply_with_openai(
-    spark_content: str,
-    spark_data: Dict[str, Any],
-    messages: List[Dict[str, str]],
-    api_key: str,
-    model: str = "gpt-4o-mini",
-) -> Dict[str, str]:
-    """Generate an AI workbench reply using OpenAI.
+def strip_json_fences(content: str) -> str:
+    cleaned = content.strip()
+    if cleaned.startswith("```json"):
+        cleaned = cleaned[7:]
+    if cleaned.startswith("```"):
+        cleaned = cleaned[3:]
+    if cleaned.endswith("```"):
+        cleaned = cleaned[:-3]
+    return cleaned.strip()
+
+
+EDIT_MODES = ("full", "patch")
+
+# Reply contract used instead of the full-document one in "patch" edit mode.
+PATCH_REPLY_CONTRACT = (
+    "Always respond with ONLY a JSON object (no markdown fences, no extra prose) "
+    "with this exact shape:\n"
+    "{\n  \"reply\": \"short conversational response to the user\",\n  "
+    "\"patches\": [list of edits to the spark, or an empty list when you are only discussing]\n}\n\n"
+    "Each patch is one of:\n"
+    "  {\"op\": \"replace\", \"section\": \"<heading text>\", \"content\": \"<new markdown for the whole section, heading line included>\"}\n"
+    "  {\"op\": \"insert_after\", \"section\": \"<heading text>\", \"content\": \"<markdown of a new section>\"}\n"
+    "  {\"op\": \"delete\", \"section\": \"<heading text>\"}\n"
+    "  {\"op\": \"diff\", \"diff\": \"<unified diff against the spark, with @@ hunk headers and context lines>\"}\n"
+    "Sections are named by their markdown heading text without the leading #s; "
+    "use \"frontmatter\" for the YAML frontmatter. Only include the parts you change, never the whole document. "
+    "Do not include any keys other than reply and patches."
+)
 
-    Returns a dict with keys:
-      - reply: natural-language assistant message
-      - updatedSpark: full markdown string with the updated spark, or empty string if no changes
+
+def get_edit_mode(payload: Dict[str, Any]) -> str:
+    """The requested edit mode ("full" or "patch"); AGENT_EDIT_MODE is the default."""
+    edit_mode = payload.get("edit_mode") or get_env("AGENT_EDIT_MODE", "full")
+    if edit_mode not in EDIT_MODES:
+        raise ApiError(f"edit_mode must be one of {', '.join(EDIT_MODES)}")
+    return edit_mode
+
+
+class SparkPatchError(ValueError):
+    """A model-proposed patch that does not apply to the spark."""
+
+
+def spark_section_spans(lines: List[str]) -> List[Tuple[str, int, int]]:
+    """(title, start, end) line ranges of a spark's sections.
+
+    Sections match chunk_spark_by_section: the YAML frontmatter, the text
+    before the first heading ("Introduction") and one per heading outside
+    code fences.
     """
-    if not OPENAI_AVAILABLE:
-        raise RuntimeError("OpenAI SDK not installed")
+    spans: List[Tuple[str, int, int]] = []
+    start = 0
+    if lines and lines[0].strip() == "---":
+        for index in range(1, len(lines)):
+            if lines[index].strip() == "---":
+                spans.append(("frontmatter", 0, index + 1))
+                start = index + 1
+                break
 
-    try:
-        client = openai.OpenAI(api_key=api_key)
-    except TypeError as e:
-        raise RuntimeError(
-            f"OpenAI client initialization failed. Please ensure openai>=1.30.0 is installed. Error: {e}"
-        )
+    title, section_start, in_fence = "Introduction", start, False
+    for index in range(start, len(lines)):
+        if lines[index].lstrip().startswith("```"):
+            in_fence = not in_fence
+        heading = None if in_fence else MARKDOWN_HEADING.match(lines[index])
+        if heading:
+            if index > section_start and "".join(lines[section_start:index]).strip():
+                spans.append((title, section_start, index))
+            title, section_start = heading.group(1) or title, index
+    if len(lines) > section_start and "".join(lines[section_start:]).strip():
+        spans.append((title, section_start, len(lines)))
+    return spans
+
+
+def find_spark_section(lines: List[str], name: Any) -> Tuple[int, int]:
+    if not isinstance(name, str) or not name.strip():
+        raise SparkPatchError("patch is missing its section")
+    wanted = name.strip().lstrip("#").strip().lower()
+    matches = [(start, end) for title, start, end in spark_section_spans(lines) if title.strip().lower() == wanted]
+    if not matches:
+        raise SparkPatchError(f"section '{name}' not found")
+    if len(matches) > 1:
+        raise SparkPatchError(f"section '{name}' is ambiguous")
+    return matches[0]
+
+
+def section_lines(content: Any, keep_gap: bool) -> List[str]:
+    if not isinstance(content, str) or not content.strip():
+        raise SparkPatchError("patch is missing its content")
+    new_lines = content.strip("\n").split("\n")
+    return new_lines + [""] if keep_gap else new_lines
+
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def apply_unified_diff(lines: List[str], diff: Any) -> List[str]:
+    """Apply a unified diff to lines.
+
+    Hunks are located by their context: at the stated line when it matches,
+    otherwise at the nearest place after the previous hunk where it does.
+    Trailing whitespace is ignored when matching.
+    """
+    if not isinstance(diff, str) or "@@" not in diff:
+        raise SparkPatchError("diff has no hunks")
+    hunks: List[Tuple[int, List[str]]] = []
+    for line in diff.split("\n"):
+        header = HUNK_HEADER.match(line)
+        if header:
+            hunks.append((int(header.group(1)), []))
+        elif hunks and not line.startswith(("\\", "--- ", "+++ ")):
+            hunks[-1][1].append(line)
+
+    result = list(lines)
+    offset = cursor = 0
+    for old_start, body in hunks:
+        while body and body[-1] == "":
+            body.pop()
+        # Models often drop the space that marks an empty context line.
+        body = [line or " " for line in body]
+        if any(line[0] not in " +-" for line in body):
+            raise SparkPatchError("diff hunk has lines without a ' ', '+' or '-' prefix")
+        old = [line[1:].rstrip() for line in body if line[0] in " -"]
+        new = [line[1:] for line in body if line[0] in " +"]
+
+        expected = max(0, old_start - 1 + offset) if old else max(0, min(old_start + offset, len(result)))
+        candidates = [
+            pos for pos in range(cursor, len(result) - len(old) + 1)
+            if [line.rstrip() for line in result[pos:pos + len(old)]] == old
+        ]
+        if not candidates:
+            raise SparkPatchError(f"diff hunk at line {old_start} does not match the spark")
+        position = expected if expected in candidates or not old else min(candidates, key=lambda pos: abs(pos - expected))
+        result[position:position + len(old)] = new
+        offset += len(new) - len(old)
+        cursor = position + len(new)
+    return result
+
+
+def apply_spark_patches(spark_content: str, patches: Any) -> str:
+    """Apply model-proposed section patches and unified diffs, in order.
+
+    Raises SparkPatchError when a patch is malformed or does not apply.
+    """
+    if not isinstance(patches, list):
+        raise SparkPatchError("patches must be a list")
+    lines = spark_content.split("\n")
+    for patch in patches:
+        if not isinstance(patch, dict):
+            raise SparkPatchError("each patch must be an object")
+        op = patch.get("op") or ("diff" if "diff" in patch else "replace")
+        if op == "diff":
+            lines = apply_unified_diff(lines, patch.get("diff"))
+            continue
+        start, end = find_spark_section(lines, patch.get("section"))
+        # Keep the blank line (or final newline) that ended the section.
+        keep_gap = not lines[end - 1].strip()
+        if op == "replace":
+            lines[start:end] = section_lines(patch.get("content"), keep_gap)
+        elif op == "insert_after":
+            if not keep_gap:
+                lines.insert(end, "")
+                end += 1
+            lines[end:end] = section_lines(patch.get("content"), True)
+        elif op == "delete":
+            del lines[start:end]
+        else:
+            raise SparkPatchError(f"unsupported patch op '{op}'")
+    return "\n".join(lines)
 
-    # Compress conversation for the model
-    history_lines: List[str] = []
-    for m in messages[-10:]:  # limit history to last 10 turns
-        role = (m.get("role") or "user").capitalize()
-        content = m.get("content") or ""
-        history_lines.append(f"{role}: {content}")
 
-    payload = {
-        "sparkName": spark_data.get("name"),
-        "sparkContent": spark_content[:10000],
-        "conversation": history_lines,
+def parse_agent_reply(content: str, spark_content: Optional[str] = None) -> Dict[str, Any]:
+    """Parse the shared {reply, updatedSpark} JSON contract from model output.
+
+    In patch edit mode the model returns {reply, patches} instead; pass the
+    spark the patches were made against to get the full updatedSpark. The
+    result then has an "edit" entry with the number of patches applied, or
+    the error when they could not be applied (updatedSpark is left empty).
+    """
+    data = json.loads(strip_json_fences(content))
+    result: Dict[str, Any] = {
+        "reply": data.get("reply") or "",
+        "updatedSpark": data.get("updatedSpark") or "",
     }
+    if spark_content is not None and "patches" in data:
+        patches = data.get("patches") or []
+        edit: Dict[str, Any] = {"mode": "patch", "patches": len(patches) if isinstance(patches, list) else 0}
+        try:
+            if patches:
+                result["updatedSpark"] = apply_spark_patches(spark_content, patches)
+        except SparkPatchError as err:
+            edit["error"] = f"Could not apply the proposed edit: {err}"
+        result["edit"] = edit
+    return result
+
 
+def build_workbench_messages(
+    spark_content: str,
+    spark_data: Dict[str, Any],
+    messages: List[Dict[str, str]],
+    model: str = "gpt-4o-mini",
+    edit_mode: str = "full",
+) -> List[Dict[str, str]]:
     system_prompt = (
         "You are an AI workbench helping iteratively improve a Spark markdown document.\n"
         "Always respond with **only** a JSON object (no markdown fences, no extra prose) with this exact shape:\n"
@@ -614,44 +3535,42 @@ def generate_workbench_reply_with_openai(
         "If you suggest specific edits, include the entire updated spark document in updatedSpark. "
         "Do not include any keys other than reply and updatedSpark."
     )
-
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(payload)},
-            ],
-            temperature=0.5,
-            max_tokens=2000,
+    if edit_mode == "patch":
+        system_prompt = (
+            "You are an AI workbench helping iteratively improve a Spark markdown document.\n"
+            + PATCH_REPLY_CONTRACT
         )
 
-        content = response.choices[0].message.content or ""
-        content = content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
-
-        data = json.loads(content)
-        reply = data.get("reply") or ""
-        updated_spark = data.get("updatedSpark") or ""
-        return {"reply": reply, "updatedSpark": updated_spark}
-    except json.JSONDecodeError as err:
-        raise RuntimeError(f"OpenAI returned invalid JSON for workbench reply: {err}")
-    except Exception as err:
-        raise RuntimeError(f"OpenAI API error (workbench): {err}")
+    # Fit the spark and as much recent conversation as the model allows
+    history_items = conversation_lines_newest_first(messages)
+    packed, _ = pack_context(model, get_context_budget(model, 2000), [
+        ("system_prompt", [system_prompt], "required"),
+        ("latest_turn", history_items[:1], "required"),
+        ("spark_content", [spark_content], "truncate"),
+        ("history", history_items[1:], "prefix"),
+    ])
+
+    # The spark goes before the conversation so the prompt prefix stays
+    # identical across turns and hits the provider's prompt cache.
+    spark_block = {
+        "sparkName": spark_data.get("name"),
+        "sparkContent": "".join(packed["spark_content"]),
+    }
+    turn_block = {"conversation": list(reversed(packed["latest_turn"] + packed["history"]))}
 
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": json.dumps(spark_block)},
+        {"role": "user", "content": json.dumps(turn_block)},
+    ]
 
 
+def prepare_workbench_turn(payload: Dict[str, Any], asynchronous: bool = False) -> Dict[str, Any]:
+    """Validate an AI workbench chat turn and build its OpenAI request.
 
-@app.post("/api/workbench/message")
-def workbench_message():
-    """Handle a single AI workbench chat turn using OpenAI via the backend proxy."""
-    payload = request.get_json(silent=True) or {}
+    Returns {"client", "request", "parse"}, where parse turns the model's
+    output into the response body; raises ApiError for invalid requests.
+    """
     provider = payload.get("provider") or "openai"
     api_key = payload.get("apiKey")
     spark_content = payload.get("sparkContent") or ""
@@ -660,61 +3579,241 @@ def workbench_message():
     model_override = payload.get("model") or "gpt-4o-mini"
 
     if provider != "openai":
-        return jsonify({"error": "provider must be 'openai'"}), 400
+        raise ApiError("provider must be 'openai'")
     if not spark_content:
-        return jsonify({"error": "sparkContent is required"}), 400
+        raise ApiError("sparkContent is required")
     if not isinstance(messages, list) or not messages:
-        return jsonify({"error": "messages array with at least one item is required"}), 400
+        raise ApiError("messages array with at least one item is required")
+    edit_mode = get_edit_mode(payload)
 
     if not api_key:
         api_key = os.environ.get("OPENAI_API_KEY")
         if not api_key:
-            return jsonify({"error": "OpenAI API key required. Please enter your API key in the AI Workbench."}), 400
+            raise ApiError("OpenAI API key required. Please enter your API key in the AI Workbench.")
 
+    if not OPENAI_AVAILABLE:
+        raise ApiError("OpenAI SDK not installed", status=502)
     try:
-        result = generate_workbench_reply_with_openai(
-            spark_content,
-            spark_data,
-            messages,
-            api_key,
-            model=model_override,
+        client = get_llm_client("openai", api_key, asynchronous)
+    except TypeError as e:
+        raise ApiError(
+            f"OpenAI client initialization failed. Please ensure openai>=1.30.0 is installed. Error: {e}",
+            status=502,
         )
-        return jsonify(result)
-    except RuntimeError as err:
-        return jsonify({"error": str(err)}), 502
+
+    return {
+        "client": client,
+        "request": {
+            "model": model_override,
+            "messages": build_workbench_messages(spark_content, spark_data, messages, model_override, edit_mode),
+            "temperature": 0.5,
+            "max_tokens": 2000,
+        },
+        "parse": lambda content: parse_agent_reply(content, spark_content if edit_mode == "patch" else None),
+    }
+
+
+def stream_openai_text(client: Any, usage_sink: Optional[Dict[str, int]] = None, **kwargs: Any) -> Iterator[str]:
+    """Yield the text deltas of a streamed OpenAI chat completion.
+
+    When usage_sink is given, the final token usage is written into it.
+    """
+    if usage_sink is not None:
+        kwargs["stream_options"] = {"include_usage": True}
+    for chunk in client.chat.completions.create(stream=True, **kwargs):
+        if usage_sink is not None and getattr(chunk, "usage", None):
+            usage_sink.update(llm_usage_report(chunk.usage))
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
+def stream_anthropic_text(client: Any, usage_sink: Optional[Dict[str, int]] = None, **kwargs: Any) -> Iterator[str]:
+    """Yield the text deltas of a streamed Anthropic message.
+
+    When usage_sink is given, the final token usage is written into it.
+    """
+    with client.messages.stream(**kwargs) as stream:
+        for text in stream.text_stream:
+            if text:
+                yield text
+        if usage_sink is not None:
+            usage_sink.update(llm_usage_report(stream.get_final_message().usage) or {})
+
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ReplyStreamExtractor:
+    """Incrementally decode the "reply" string of a streamed JSON reply.
+
+    Models answer with {"reply": "...", "updatedSpark": "..."}; this lets
+    the browser render the conversational reply while the JSON object is
+    still being generated.
+    """
+
+    REPLY_KEY = re.compile(r'"reply"\s*:\s*"')
+    ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._pos: Optional[int] = None
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        if self._done:
+            return ""
+        if self._pos is None:
+            match = self.REPLY_KEY.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        buf = self._buffer
+        i = self._pos
+        out: List[str] = []
+        while i < len(buf):
+            ch = buf[i]
+            if ch == "\\":
+                if i + 1 >= len(buf):
+                    break
+                esc = buf[i + 1]
+                if esc == "u":
+                    if i + 6 > len(buf):
+                        break
+                    try:
+                        out.append(chr(int(buf[i + 2:i + 6], 16)))
+                    except ValueError:
+                        pass
+                    i += 6
+                    continue
+                out.append(self.ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if ch == '"':
+                self._done = True
+                i += 1
+                break
+            out.append(ch)
+            i += 1
+        self._pos = i
+        return "".join(out)
+
+
+def stream_model_reply(deltas: Iterator[str], finalize: Callable[[str], Dict[str, Any]]) -> Iterator[str]:
+    """Relay model deltas as SSE events and finish with the parsed result.
+
+    Emits "token" events ({delta, reply}) while the model generates, then a
+    single "done" event carrying the same JSON object the non-streaming
+    endpoint returns, or an "error" event.
+    """
+    extractor = ReplyStreamExtractor()
+    parts: List[str] = []
+    try:
+        for delta in deltas:
+            parts.append(delta)
+            yield format_sse("token", {"delta": delta, "reply": extractor.feed(delta)})
+        yield format_sse("done", finalize("".join(parts)))
+    except json.JSONDecodeError as err:
+        yield format_sse("error", {"error": f"Model returned invalid JSON: {err}"})
+    except Exception as err:  # noqa: BLE001
+        yield format_sse("error", {"error": f"Model stream failed: {err}"})
+
+
+def sse_response(events: Iterator[str]) -> Response:
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def wants_event_stream(payload: Dict[str, Any]) -> bool:
+    """True when the caller opted into SSE via {"stream": true} or the Accept header."""
+    return payload.get("stream") is True or "text/event-stream" in (request.headers.get("Accept") or "")
+
+
+@app.post("/api/workbench/message")
+def workbench_message():
+    """Handle a single AI workbench chat turn using OpenAI via the backend proxy."""
+    payload = request.get_json(silent=True) or {}
+    try:
+        turn = prepare_workbench_turn(payload)
+    except ApiError as err:
+        return jsonify(err.to_dict()), err.status
+
+    if wants_event_stream(payload):
+        deltas = guard_llm_stream("openai", stream_openai_text(turn["client"], **turn["request"]))
+        return sse_response(stream_model_reply(deltas, turn["parse"]))
+
+    try:
+        response = call_llm("openai", "workbench", lambda: turn["client"].chat.completions.create(**turn["request"]))
+        return jsonify(turn["parse"](response.choices[0].message.content or ""))
+    except json.JSONDecodeError as err:
+        return jsonify({"error": f"OpenAI returned invalid JSON for workbench reply: {err}"}), 502
+    except CircuitOpenError as err:
+        return jsonify({"error": str(err)}), 503
     except Exception as err:
-        return jsonify({"error": f"AI Workbench failed: {err}"}), 500
+        return jsonify({"error": f"OpenAI API error (workbench): {err}"}), 502
+
+
+def get_retrieval_top_k() -> int:
+    return max(1, int(get_env("SPARK_RETRIEVAL_TOP_K", "4")))
 
 
 @app.post("/api/rag/assemble")
 def rag_assemble():
-    """Minimal RAG service for Phase 1.
+    """Retrieve sections of related sparks for a spark.
 
-    For now, this endpoint performs a lightweight "assembly" step by
-    echoing back a technical summary stub. In later phases this can
-    call GitHub/code search and other tools.
+    Runs a BM25 search over the sections of every spark in the repository
+    (crawling it first if it has not been indexed) using `query`, or the
+    spark content when no query is given. Pass "retriever": "dense" to rank
+    by local embeddings instead. `retrieved_snippets` can be passed straight
+    to /api/model/infer.
     """
     payload = request.get_json(silent=True) or {}
     spark_content = payload.get("sparkContent") or ""
     spark_data = payload.get("sparkData") or {}
     task_type = payload.get("task_type") or "improve_spark_maturity"
+    repo_input = payload.get("repo") or get_env("SPARK_REPO", "rvishravars/primer")
+    branch = payload.get("branch") or "main"
+    query = payload.get("query") or spark_content
+    exclude_path = payload.get("path") or (spark_data or {}).get("sourcePath")
+    retriever = payload.get("retriever") or "bm25"
 
     if not spark_content:
         return jsonify({"error": "sparkContent is required"}), 400
 
+    try:
+        k = int(payload.get("k") or get_retrieval_top_k())
+    except (TypeError, ValueError):
+        return jsonify({"error": "k must be an integer"}), 400
+
     name = (spark_data or {}).get("name") or "Unnamed Spark"
 
-    # In Phase 1, we don't yet perform real retrieval; instead we
-    # return a structured stub that downstream agents can use.
-    technical_sections = {
-        "3": f"Automated notes for simulation/modeling plan when running task '{task_type}' on spark '{name}'.",
-        "4": f"Automated notes for evaluation strategy for spark '{name}'.",
-    }
+    started = time.perf_counter()
+    try:
+        results = retrieve_spark_snippets(
+            repo_input, branch, query, k=k, exclude_path=exclude_path, retriever=retriever
+        )
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    except RuntimeError as err:
+        return jsonify({"error": str(err)}), 502
+    took_ms = round((time.perf_counter() - started) * 1000, 2)
 
     return jsonify({
         "task_type": task_type,
         "spark_name": name,
-        "technical_sections": technical_sections,
+        "technical_sections": {f"{r['path']} § {r['section']}": r["text"] for r in results},
+        "retrieved_snippets": [format_snippet(r) for r in results],
+        "results": results,
+        "retriever": retriever,
+        "took_ms": took_ms,
     })
 
 
@@ -734,10 +3833,8 @@ def get_prs_for_spark():
     repo = parsed["repo"]
     cache_key = f"{owner}/{repo}:{spark_path}"
 
-    now = int(time.time() * 1000)
-    ttl_ms = get_cache_ttl_ms()
-    cached = pr_cache["data"].get(cache_key)
-    if cached and now - pr_cache["timestamp"] < ttl_ms:
+    cached = pr_cache.get(cache_key, max_age_ms=get_cache_ttl_ms())
+    if cached:
         return jsonify({**cached, "cached": True})
 
     token = None
@@ -746,17 +3843,24 @@ def get_prs_for_spark():
         token = auth_header.replace("Bearer ", "").strip()
 
     try:
-        result = get_open_activity_count(owner, repo, spark_path, token)
+        result = single_flight.do(
+            "prs",
+            f"{credential_fingerprint(build_github_headers_with_token(token))}:{cache_key}",
+            lambda: get_open_activity_count(owner, repo, spark_path, token),
+        )
         response = {
             "count": result["count"],
             "items": result["items"],
             "can_push": result["can_push"],
             "cached": False,
         }
-        pr_cache["data"][cache_key] = response
-        pr_cache["timestamp"] = now
+        pr_cache.set(cache_key, response)
         return jsonify(response)
     except Exception as err:
+        stale = pr_cache.get(cache_key)
+        if stale:
+            count_resilience("stale_served", "prs")
+            return jsonify({**stale, "cached": True, "stale": True})
         return jsonify({"error": str(err)}), 502
 
 
@@ -775,36 +3879,24 @@ def get_contributors():
     owner = parsed["owner"]
     repo = parsed["repo"]
     headers = build_github_headers()
-    
-    # Filter for contributors who have raised issues/proposals related to the spark
-    spark_name = spark_path.split("/")[-1].replace(".spark.md", "")
-    
-    # We fetch ALL issues to get historical contributors as well
-    url = f"https://api.github.com/repos/{owner}/{repo}/issues?state=all&per_page=100"
-    
+
+    # Contributors who have raised issues/proposals (open or closed) that
+    # mention the spark, read from the shared issue store.
     try:
-        issues = fetch_json(url, headers)
+        issue_store = get_issue_store(owner, repo)
+        issue_store.ensure_fresh(headers, get_cache_ttl_ms())
         contributors_map = {}
-        
-        for issue in issues:
-            # Skip actual Pull Requests to focus on proposal contributors
-            if issue.get("pull_request"):
-                continue
-                
-            title = issue.get("title", "").lower()
-            body = issue.get("body", "").lower() if issue.get("body") else ""
-            
-            if spark_name.lower() in title or spark_name.lower() in body:
-                user = issue.get("user")
-                if user:
-                    login = user.get("login")
-                    if login not in contributors_map:
-                        contributors_map[login] = {
-                            "login": login,
-                            "avatar_url": user.get("avatar_url"),
-                            "html_url": user.get("html_url")
-                        }
-        
+
+        for issue in issue_store.mentions(spark_name_from_path(spark_path)):
+            user = issue["user"]
+            login = user.get("login")
+            if login and login not in contributors_map:
+                contributors_map[login] = {
+                    "login": login,
+                    "avatar_url": user.get("avatar_url"),
+                    "html_url": user.get("html_url")
+                }
+
         return jsonify({"contributors": list(contributors_map.values())})
     except Exception as err:
         return jsonify({"error": str(err)}), 502
@@ -901,6 +3993,7 @@ def submit_spark_to_github(
             ),
         }
         issue = create_github_issue(owner, repo, token, issue_payload)
+        get_issue_store(owner, repo).upsert([issue], advance_since=False)
         return {
             "pr_url": issue.get("html_url"),
             "is_proposal": True,
@@ -977,8 +4070,8 @@ def submit_spark_to_github(
 
     # Invalidate PR cache
     cache_key = f"{owner}/{repo}:{path}"
-    if cache_key in pr_cache["data"]:
-        del pr_cache["data"][cache_key]
+    pr_cache.pop(cache_key)
+    get_pr_index(owner, repo).invalidate()
 
     return {
         "pr_url": pr.get("html_url"),
@@ -987,19 +4080,29 @@ def submit_spark_to_github(
     }
 
 
-@app.post("/api/agents/run")
-def run_agent():
-    """Agent Orchestrator entrypoint.
+AGENT_DEFINITIONS: Dict[str, Dict[str, str]] = {
+    "improve_spark_maturity": {
+        "description": "Audit and improve the spark's overall maturity and coherence across sections.",
+    },
+    "design_experiment_from_spark": {
+        "description": "Design or refine experiments and simulations based on this spark.",
+    },
+    "summarize_results_for_review": {
+        "description": "Summarize current results and prepare the spark for human review.",
+    },
+}
 
-    Phase 2 supports multiple task types:
-      - improve_spark_maturity
-      - design_experiment_from_spark
-      - summarize_results_for_review
 
-    Each agent uses a shared JSON contract with the model to return
-    { reply, updatedSpark }, plus lightweight context metadata.
+class AgentRunError(ApiError):
+    """An agent request that cannot be served, with the HTTP status to return."""
+
+
+def prepare_agent_run(payload: Dict[str, Any], asynchronous: bool = False) -> Dict[str, Any]:
+    """Validate an agent request and assemble its prompt and model client.
+
+    Raises ApiError (AgentRunError for agent-specific problems) for invalid
+    requests or unavailable providers.
     """
-    payload = request.get_json(silent=True) or {}
     task_type = payload.get("task_type") or "improve_spark_maturity"
     provider = payload.get("provider") or "openai"
     api_key = payload.get("apiKey")
@@ -1009,11 +4112,11 @@ def run_agent():
     model_override = payload.get("model") or "gpt-4o-mini"
 
     if provider not in ("openai", "anthropic"):
-        return jsonify({"error": "Only 'openai' and 'anthropic' providers are supported for agents in this phase"}), 400
+        raise AgentRunError("Only 'openai' and 'anthropic' providers are supported for agents in this phase")
     if not spark_content:
-        return jsonify({"error": "sparkContent is required"}), 400
+        raise AgentRunError("sparkContent is required")
     if not isinstance(messages, list) or not messages:
-        return jsonify({"error": "messages array with at least one item is required"}), 400
+        raise AgentRunError("messages array with at least one item is required")
 
     if not api_key:
         if provider == "openai":
@@ -1021,29 +4124,44 @@ def run_agent():
         elif provider == "anthropic":
             api_key = os.environ.get("ANTHROPIC_API_KEY")
         if not api_key:
-            return jsonify({"error": f"{provider.capitalize()} API key required. Please enter your API key in the LLM Login."}), 400
-
-    agent_definitions = {
-        "improve_spark_maturity": {
-            "description": "Audit and improve the spark's overall maturity and coherence across sections.",
-        },
-        "design_experiment_from_spark": {
-            "description": "Design or refine experiments and simulations based on this spark.",
-        },
-        "summarize_results_for_review": {
-            "description": "Summarize current results and prepare the spark for human review.",
-        },
-    }
+            raise AgentRunError(f"{provider.capitalize()} API key required. Please enter your API key in the LLM Login.")
 
-    if task_type not in agent_definitions:
-        return jsonify({"error": f"Unsupported task_type '{task_type}' for Phase 2 agents"}), 400
+    if task_type not in AGENT_DEFINITIONS:
+        raise AgentRunError(f"Unsupported task_type '{task_type}' for Phase 2 agents")
+    edit_mode = get_edit_mode(payload)
 
-    # Minimal RAG-style technical sections stub
-    name = (spark_data or {}).get("name") or "Unnamed Spark"
-    technical_sections = {
-        "3": f"Automated notes for simulation/modeling plan when running task '{task_type}' on spark '{name}'.",
-        "4": f"Automated notes for evaluation strategy for spark '{name}'.",
-    }
+    # Related sections from other sparks in the repository (BM25). A repo
+    # named in the request is indexed on demand; the default repo is only
+    # used when it has already been indexed.
+    query = "\n".join([spark_content, (messages[-1] or {}).get("content") or ""])
+    try:
+        results = retrieve_spark_snippets(
+            payload.get("repo") or get_env("SPARK_REPO", "rvishravars/primer"),
+            payload.get("branch") or "main",
+            query,
+            k=get_retrieval_top_k(),
+            exclude_path=payload.get("path") or spark_data.get("sourcePath"),
+            build=bool(payload.get("repo")),
+        )
+    except Exception as err:  # noqa: BLE001
+        print(f"Retrieval failed for agent run: {err}")
+        results = []
+    technical_sections = {f"{r['path']} § {r['section']}": r["text"] for r in results}
+
+    # Optional "related_sparks": true (or a count) adds the most similar
+    # sparks by dense vectors. Only already-indexed data is used, so this
+    # never triggers a GitHub call.
+    related_sparks = []
+    if payload.get("related_sparks") and "dense" in RETRIEVERS:
+        related_k = payload["related_sparks"]
+        related_k = related_k if isinstance(related_k, int) and not isinstance(related_k, bool) else 3
+        related_sparks = find_related_sparks(
+            payload.get("repo") or get_env("SPARK_REPO", "rvishravars/primer"),
+            payload.get("branch") or "main",
+            query,
+            max(1, min(related_k, 10)),
+            payload.get("path") or spark_data.get("sourcePath"),
+        )
 
     # Log basic trace info for this agent run.
     app.logger.info(
@@ -1056,37 +4174,26 @@ def run_agent():
     )
 
     # Build model client based on provider
-    openai_client = None
-    anthropic_client = None
     if provider == "openai":
         if not OPENAI_AVAILABLE:
-            return jsonify({"error": "OpenAI SDK not installed"}), 500
+            raise AgentRunError("OpenAI SDK not installed", status=500)
         try:
-            openai_client = openai.OpenAI(api_key=api_key)
+            client = get_llm_client("openai", api_key, asynchronous)
         except TypeError as e:
-            return jsonify({
-                "error": "OpenAI client initialization failed. Ensure openai>=1.30.0 is installed.",
-                "details": str(e),
-            }), 500
-    elif provider == "anthropic":
+            raise AgentRunError(
+                "OpenAI client initialization failed. Ensure openai>=1.30.0 is installed.",
+                status=500,
+                details=str(e),
+            )
+    else:
         if not ANTHROPIC_AVAILABLE:
-            return jsonify({"error": "Anthropic SDK not installed"}), 500
+            raise AgentRunError("Anthropic SDK not installed", status=500)
         try:
-            anthropic_client = anthropic.Anthropic(api_key=api_key)
+            client = get_llm_client("anthropic", api_key, asynchronous)
         except Exception as e:  # noqa: BLE001
-            return jsonify({
-                "error": "Anthropic client initialization failed.",
-                "details": str(e),
-            }), 500
-
-    # Compress recent conversation
-    history_lines: List[str] = []
-    for m in messages[-10:]:
-        role = (m.get("role") or "user").capitalize()
-        content = m.get("content") or ""
-        history_lines.append(f"{role}: {content}")
+            raise AgentRunError("Anthropic client initialization failed.", status=500, details=str(e))
 
-    agent_desc = agent_definitions[task_type]["description"]
+    agent_desc = AGENT_DEFINITIONS[task_type]["description"]
 
     system_prompt = (
         "You are an agent in Primer's Spark Assembly Lab.\n"
@@ -1098,76 +4205,401 @@ def run_agent():
         "If you suggest specific edits, include the entire updated spark document in updatedSpark. "
         "Do not include any keys other than reply and updatedSpark."
     )
+    if edit_mode == "patch":
+        system_prompt = (
+            "You are an agent in Primer's Spark Assembly Lab.\n"
+            f"Your current task type is: {task_type}. {agent_desc}\n"
+            + PATCH_REPLY_CONTRACT
+        )
 
-    user_payload = {
+    # Pack the spark, technical sections and conversation into the model's
+    # token budget in priority order.
+    history_items = conversation_lines_newest_first(messages)
+    budget = get_context_budget(model_override, 2000)
+    packed, usage = pack_context(model_override, budget, [
+        ("system_prompt", [system_prompt], "required"),
+        ("latest_turn", history_items[:1], "required"),
+        ("spark_content", [spark_content], "truncate"),
+        ("technical_sections", list(technical_sections.values()), "skip"),
+        ("related_sparks", [json.dumps(item) for item in related_sparks], "skip"),
+        ("history", history_items[1:], "prefix"),
+    ])
+    included_sections = set(packed["technical_sections"])
+    included_related = set(packed["related_sparks"])
+
+    # Stable parts first (system prompt, then the spark) and the parts that
+    # change every turn (retrieved context, conversation) last, so provider
+    # prompt caches can reuse the prefix across turns of a conversation.
+    spark_block = {
         "sparkName": spark_data.get("name"),
         "task_type": task_type,
-        "sparkContent": spark_content[:10000],
-        "technical_sections": technical_sections,
-        "conversation": history_lines,
+        "sparkContent": "".join(packed["spark_content"]),
     }
+    turn_block: Dict[str, Any] = {
+        "technical_sections": {key: value for key, value in technical_sections.items() if value in included_sections},
+        "conversation": list(reversed(packed["latest_turn"] + packed["history"])),
+    }
+    if related_sparks:
+        turn_block["relatedSparks"] = [item for item in related_sparks if json.dumps(item) in included_related]
+    user_payload = {**spark_block, **turn_block}
+    prompt_blocks = [json.dumps(spark_block), json.dumps(turn_block)]
 
-    messages_for_model = [
+    context_tokens = context_usage_report(model_override, budget, usage, [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps(user_payload)},
-    ]
+        *({"role": "user", "content": block} for block in prompt_blocks),
+    ])
+    token_estimate = context_tokens["total"]
+
+    cache_key = None
+    if payload.get("cacheable") is True:
+        cache_key = llm_response_cache_key(provider, model_override, system_prompt, user_payload, 0.5)
+
+    return {
+        "provider": provider,
+        "model": model_override,
+        "task_type": task_type,
+        "edit_mode": edit_mode,
+        "spark_content": spark_content,
+        "cache_key": cache_key,
+        "client": client,
+        "system_prompt": system_prompt,
+        "user_payload": user_payload,
+        "prompt_blocks": prompt_blocks,
+        "technical_sections": technical_sections,
+        "related_sparks": related_sparks,
+        "token_estimate": token_estimate,
+        "context_tokens": context_tokens,
+    }
+
+
+def agent_request_kwargs(run: Dict[str, Any]) -> Dict[str, Any]:
+    """Provider-specific keyword arguments for the model call of an agent run.
+
+    The system prompt and the spark block form the prompt prefix. OpenAI
+    caches long identical prefixes automatically; for Anthropic the end of
+    the system prompt and of the spark block are marked as cache breakpoints.
+    """
+    spark_block, turn_block = run["prompt_blocks"]
+    if run["provider"] == "openai":
+        return {
+            "model": run["model"],
+            "messages": [
+                {"role": "system", "content": run["system_prompt"]},
+                {"role": "user", "content": spark_block},
+                {"role": "user", "content": turn_block},
+            ],
+            "temperature": 0.5,
+            "max_tokens": 2000,
+        }
+    return {
+        "model": run["model"],
+        "max_tokens": 2000,
+        "temperature": 0.5,
+        "system": [{"type": "text", "text": run["system_prompt"], "cache_control": {"type": "ephemeral"}}],
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": spark_block, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": turn_block},
+            ],
+        }],
+    }
+
+
+def llm_usage_report(usage: Any) -> Optional[Dict[str, int]]:
+    """Token usage of a model call, including provider prompt-cache reads and writes.
+
+    input_tokens counts the whole prompt for both providers (Anthropic
+    reports cached tokens separately from input_tokens).
+    """
+    if usage is None:
+        return None
+    if hasattr(usage, "prompt_tokens"):
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "input_tokens": usage.prompt_tokens or 0,
+            "output_tokens": usage.completion_tokens or 0,
+            "cache_read_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "cache_write_tokens": 0,
+        }
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    return {
+        "input_tokens": (getattr(usage, "input_tokens", 0) or 0) + cache_read + cache_write,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_tokens": cache_read,
+        "cache_write_tokens": cache_write,
+    }
+
+
+def complete_agent_run(run: Dict[str, Any]) -> str:
+    """Run the model call for a prepared agent run and return its text output.
 
-    token_estimate = estimate_tokens(system_prompt) + estimate_tokens(spark_content) + estimate_tokens("\n".join(technical_sections.values()))
+    The call's token usage is recorded in run["usage"].
+    """
+    client = run["client"]
+    if run["provider"] == "openai":
+        response = call_llm("openai", "agents_run", lambda: client.chat.completions.create(**agent_request_kwargs(run)))
+        run["usage"] = llm_usage_report(getattr(response, "usage", None))
+        return response.choices[0].message.content or ""
+
+    response = call_llm("anthropic", "agents_run", lambda: client.messages.create(**agent_request_kwargs(run)))
+    run["usage"] = llm_usage_report(getattr(response, "usage", None))
+    return anthropic_response_text(response)
+
+
+def anthropic_response_text(response: Any) -> str:
+    # Anthropic returns a list of content blocks; concatenate text parts.
+    content_parts = []
+    for block in response.content:
+        if getattr(block, "type", None) == "text":
+            content_parts.append(getattr(block, "text", ""))
+        elif isinstance(block, dict) and block.get("type") == "text":
+            content_parts.append(block.get("text", ""))
+    return "".join(content_parts).strip()
+
+
+def stream_agent_run(run: Dict[str, Any]) -> Iterator[str]:
+    """Yield the model's text deltas for a prepared agent run.
+
+    Token usage is filled into run["usage"] when the stream ends.
+    """
+    run["usage"] = {}
+    if run["provider"] == "openai":
+        return guard_llm_stream("openai", stream_openai_text(run["client"], run["usage"], **agent_request_kwargs(run)))
+    return guard_llm_stream("anthropic", stream_anthropic_text(run["client"], run["usage"], **agent_request_kwargs(run)))
+
+
+def finalize_agent_run(run: Dict[str, Any], content: str, cache_status: Optional[str] = None) -> Dict[str, Any]:
+    """Parse model output into the /api/agents/run response body.
+
+    Valid output of a cacheable run is stored in the response cache.
+    """
+    result = parse_agent_reply(content, run["spark_content"] if run["edit_mode"] == "patch" else None)
+    if cache_status is None:
+        cache_status = "miss" if run["cache_key"] else "bypass"
+    if cache_status == "miss":
+        llm_response_cache.set(run["cache_key"], content)
+    return {
+        "reply": result["reply"],
+        "updatedSpark": result["updatedSpark"],
+        "agent": {
+            "task_type": run["task_type"],
+            "technical_sections": run["technical_sections"],
+            "related_sparks": run["related_sparks"],
+            "edit": result.get("edit") or {"mode": run["edit_mode"]},
+        },
+        "context": {
+            "estimated_tokens": run["token_estimate"],
+            "tokens": run["context_tokens"],
+            "response_cache": cache_status,
+            "usage": run.get("usage") or None,
+        },
+    }
+
+
+@app.post("/api/agents/run")
+def run_agent():
+    """Agent Orchestrator entrypoint.
+
+    Phase 2 supports multiple task types:
+      - improve_spark_maturity
+      - design_experiment_from_spark
+      - summarize_results_for_review
 
+    Each agent uses a shared JSON contract with the model to return
+    { reply, updatedSpark }, plus lightweight context metadata. Send
+    {"stream": true} (or Accept: text/event-stream) to receive the reply
+    as Server-Sent Events ending with the same object in a "done" event.
+    """
+    payload = request.get_json(silent=True) or {}
     try:
-        if provider == "openai":
-            response = openai_client.chat.completions.create(
-                model=model_override,
-                messages=messages_for_model,
-                temperature=0.5,
-                max_tokens=2000,
-            )
-            content = response.choices[0].message.content or ""
-        else:
-            response = anthropic_client.messages.create(
-                model=model_override,
-                max_tokens=2000,
-                temperature=0.5,
-                system=system_prompt,
-                messages=[{"role": "user", "content": json.dumps(user_payload)}],
-            )
-            # Anthropic returns a list of content blocks; concatenate text parts.
-            content_parts = []
-            for block in response.content:
-                if getattr(block, "type", None) == "text":
-                    content_parts.append(getattr(block, "text", ""))
-                elif isinstance(block, dict) and block.get("type") == "text":
-                    content_parts.append(block.get("text", ""))
-            content = "".join(content_parts).strip()
-
-        cleaned = content.strip()
-        if cleaned.startswith("```json"):
-            cleaned = cleaned[7:]
-        if cleaned.startswith("```"):
-            cleaned = cleaned[3:]
-        if cleaned.endswith("```"):
-            cleaned = cleaned[:-3]
-        cleaned = cleaned.strip()
-
-        data = json.loads(cleaned)
-        reply = data.get("reply") or ""
-        updated_spark = data.get("updatedSpark") or ""
+        run = prepare_agent_run(payload)
+    except ApiError as err:
+        return jsonify(err.to_dict()), err.status
+
+    cached_content = llm_response_cache.get(run["cache_key"]) if run["cache_key"] else None
+
+    if wants_event_stream(payload):
+        if cached_content is not None:
+            return sse_response(stream_model_reply(
+                iter([cached_content]),
+                lambda content: finalize_agent_run(run, content, cache_status="hit"),
+            ))
+        return sse_response(stream_model_reply(
+            stream_agent_run(run),
+            lambda content: finalize_agent_run(run, content),
+        ))
+
+    try:
+        if cached_content is not None:
+            return jsonify(finalize_agent_run(run, cached_content, cache_status="hit"))
+        content = complete_agent_run(run)
+        return jsonify(finalize_agent_run(run, content))
     except json.JSONDecodeError as err:
         return jsonify({"error": f"Agent returned invalid JSON: {err}"}), 502
+    except CircuitOpenError as err:
+        return jsonify({"error": str(err)}), 503
     except Exception as err:  # noqa: BLE001
         return jsonify({"error": f"Agent orchestrator failed: {err}"}), 500
 
-    return jsonify({
-        "reply": reply,
-        "updatedSpark": updated_spark,
-        "agent": {
+
+# Model calls in flight per provider across all agent batches.
+agent_batch_limits = {
+    provider: max(1, int(os.environ.get(f"AGENT_BATCH_CONCURRENCY_{provider.upper()}", "4")))
+    for provider in ("openai", "anthropic")
+}
+agent_batch_slots = {provider: threading.BoundedSemaphore(limit) for provider, limit in agent_batch_limits.items()}
+
+
+def agent_batch_items(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Expand a batch request into {path, task_type, messages, cacheable} items.
+
+    Accepts explicit "items", or "paths" crossed with "task_types"
+    (default improve_spark_maturity). Raises ApiError for invalid batches.
+    """
+    items = payload.get("items")
+    if items is None:
+        paths = payload.get("paths") or []
+        task_types = payload.get("task_types") or [payload.get("task_type") or "improve_spark_maturity"]
+        if not isinstance(paths, list) or not isinstance(task_types, list):
+            raise ApiError("paths and task_types must be arrays")
+        items = [{"path": path, "task_type": task_type} for path in paths for task_type in task_types]
+    if not isinstance(items, list) or not items:
+        raise ApiError("items (or paths) with at least one entry is required")
+    limit = int(get_env("AGENT_BATCH_MAX_ITEMS", "200"))
+    if len(items) > limit:
+        raise ApiError(f"At most {limit} items are allowed per batch", status=413)
+    expanded = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("path"), str) or not item["path"]:
+            raise ApiError("Every item needs a spark path")
+        task_type = item.get("task_type") or payload.get("task_type") or "improve_spark_maturity"
+        messages = item.get("messages") or payload.get("messages") or [{
+            "role": "user",
+            "content": f"Run the {task_type} task on this spark.",
+        }]
+        expanded.append({
+            "path": item["path"],
             "task_type": task_type,
-            "technical_sections": technical_sections,
-        },
-        "context": {
-            "estimated_tokens": token_estimate,
-        },
-    })
+            "messages": messages,
+            "cacheable": item.get("cacheable", payload.get("cacheable")) is True,
+        })
+    return expanded
+
+
+def load_batch_spark(owner: str, repo: str, branch: str, path: str) -> Dict[str, Any]:
+    """A spark file for a batch item, from the cached listing when present."""
+    listing = spark_cache.get(f"{owner}/{repo}:{branch}") or {}
+    for file_data in listing.get("files", []):
+        if file_data.get("path") == path and file_data.get("content"):
+            return file_data
+    return single_flight.do(
+        "spark",
+        f"{owner}/{repo}:{branch}:{path}",
+        lambda: fetch_single_spark(owner, repo, path, branch),
+    )
+
+
+def run_agent_batch_item(base: Dict[str, Any], item: Dict[str, Any], owner: str, repo: str, branch: str) -> Dict[str, Any]:
+    """Run one batch item; failures are returned in the result, never raised."""
+    started = time.time()
+    result = {"path": item["path"], "task_type": item["task_type"]}
+    try:
+        spark = load_batch_spark(owner, repo, branch, item["path"])
+        run = prepare_agent_run({
+            **base,
+            "task_type": item["task_type"],
+            "messages": item["messages"],
+            "cacheable": item["cacheable"],
+            "path": item["path"],
+            "sparkContent": spark["content"],
+            "sparkData": {"name": spark.get("name"), "sourcePath": item["path"]},
+        })
+        content = llm_response_cache.get(run["cache_key"]) if run["cache_key"] else None
+        cache_status = "hit" if content is not None else None
+        if content is None:
+            with agent_batch_slots[run["provider"]]:
+                content = complete_agent_run(run)
+        result.update(status="ok", result=finalize_agent_run(run, content, cache_status=cache_status))
+    except ApiError as err:
+        result.update(status="error", error=str(err), error_status=err.status)
+    except json.JSONDecodeError as err:
+        result.update(status="error", error=f"Agent returned invalid JSON: {err}", error_status=502)
+    except CircuitOpenError as err:
+        result.update(status="error", error=str(err), error_status=503)
+    except Exception as err:  # noqa: BLE001
+        result.update(status="error", error=f"Agent run failed: {err}", error_status=502)
+    result["took_ms"] = int((time.time() - started) * 1000)
+    return result
+
+
+@app.post("/api/agents/batch")
+def run_agent_batch():
+    """Run agents over many sparks of a repository.
+
+    Body: {"repo", "branch", "provider", "apiKey", "model", "cacheable",
+    "paths": [...], "task_types": [...]} or {"items": [{"path",
+    "task_type", "messages", "cacheable"}]}. Spark contents are read from the cached listing or
+    fetched from GitHub. Results stream back as NDJSON lines in completion
+    order, each tagged with its item index, followed by a summary line;
+    with {"stream": true} or Accept: text/event-stream they are sent as
+    "item" and "done" Server-Sent Events instead. A failed item is reported
+    in its own result and does not stop the batch. Model calls in flight are
+    capped per provider (AGENT_BATCH_CONCURRENCY_OPENAI/_ANTHROPIC).
+    """
+    payload = request.get_json(silent=True) or {}
+    provider = payload.get("provider") or "openai"
+    try:
+        if provider not in agent_batch_slots:
+            raise ApiError("Only 'openai' and 'anthropic' providers are supported for agents in this phase")
+        items = agent_batch_items(payload)
+        parsed = parse_repo_url(payload.get("repo") or get_env("SPARK_REPO", "rvishravars/primer"))
+    except ApiError as err:
+        return jsonify(err.to_dict()), err.status
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+
+    owner, repo = parsed["owner"], parsed["repo"]
+    branch = payload.get("branch") or "main"
+    base = {
+        key: payload[key]
+        for key in ("provider", "apiKey", "model", "repo", "branch", "related_sparks", "edit_mode")
+        if key in payload
+    }
+    event_stream = wants_event_stream(payload)
+    context = contextvars.copy_context()
+
+    def results() -> Iterator[str]:
+        started = time.time()
+        counts = {"ok": 0, "error": 0}
+        workers = min(len(items), agent_batch_limits[provider])
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="agent-batch")
+        try:
+            futures = {
+                pool.submit(context.copy().run, run_agent_batch_item, base, item, owner, repo, branch): index
+                for index, item in enumerate(items)
+            }
+            for future in as_completed(futures):
+                result = {"index": futures[future], **future.result()}
+                counts[result["status"]] += 1
+                if event_stream:
+                    yield format_sse("item", result)
+                else:
+                    yield json.dumps({"type": "item", **result}) + "\n"
+            summary = {"total": len(items), **counts, "took_ms": int((time.time() - started) * 1000)}
+            yield format_sse("done", summary) if event_stream else json.dumps({"type": "summary", **summary}) + "\n"
+        finally:
+            # Stop queued items if the client went away mid-batch.
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    if event_stream:
+        return sse_response(results())
+    return Response(
+        stream_with_context(results()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post("/api/delete")
@@ -1249,14 +4681,181 @@ def delete_spark():
 
         # Invalidate PR cache for this spark
         cache_key = f"{owner}/{repo}:{path}"
-        if cache_key in pr_cache["data"]:
-            del pr_cache["data"][cache_key]
+        pr_cache.pop(cache_key)
+        get_pr_index(owner, repo).invalidate()
 
         return jsonify({"pr_url": pr.get("html_url"), "branch": branch_name})
     except Exception as err:
         return jsonify({"error": str(err)}), 502
 
 
+# GitHub caps the commit list of a push payload at 20 entries.
+PUSH_PAYLOAD_MAX_COMMITS = 20
+
+webhook_stats: Dict[str, int] = {"received": 0, "rejected": 0, "applied": 0}
+_webhook_stats_lock = threading.Lock()
+
+
+def record_webhook_stat(stat: str) -> None:
+    with _webhook_stats_lock:
+        webhook_stats[stat] += 1
+
+
+def apply_spark_push(owner: str, repo: str, branch: str, event: Dict[str, Any]) -> str:
+    """Patch the cached spark listing of a branch from a push event.
+
+    Added and modified sparks are downloaded at the pushed commit and
+    removed ones are dropped, then the search indexes are re-synced. Pushes
+    whose payload cannot be trusted to list every change (forced, or with a
+    truncated commit list) fall back to a background re-crawl. Returns a
+    short status string for the webhook response.
+    """
+    cache_key = f"{owner}/{repo}:{branch}"
+    if event.get("deleted"):
+        spark_cache.pop(cache_key)
+        for retriever in RETRIEVERS:
+            search_indexes.pop(f"{retriever}:{cache_key}")
+        return "dropped"
+
+    cached = spark_cache.get(cache_key)
+    if cached is None:
+        return "not_cached"
+
+    commits = event.get("commits") or []
+    if event.get("forced") or len(commits) >= PUSH_PAYLOAD_MAX_COMMITS:
+        refresh_sparks_in_background(cache_key, owner, repo, branch, "")
+        return "refreshing"
+
+    changed: Dict[str, Dict[str, str]] = {}
+    removed = set()
+    for commit in commits:
+        author = commit.get("author") or {}
+        last_commit = {
+            key: value
+            for key, value in (("login", author.get("username")), ("name", author.get("name")), ("date", commit.get("timestamp")))
+            if value
+        }
+        for path in (commit.get("added") or []) + (commit.get("modified") or []):
+            if path.endswith(".spark.md"):
+                changed[path] = last_commit
+                removed.discard(path)
+        for path in commit.get("removed") or []:
+            if path.endswith(".spark.md"):
+                changed.pop(path, None)
+                removed.add(path)
+
+    if not changed and not removed:
+        return "unchanged"
+
+    headers = build_github_headers()
+    ref = event.get("after") or branch
+
+    def load(path: str) -> Optional[str]:
+        try:
+            return fetch_text(f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{urllib.parse.quote(path)}", headers)
+        except Exception as err:
+            print(f"Failed to fetch pushed spark {path}: {err}")
+            return None
+
+    contents = dict(zip(changed, run_bounded(load, list(changed))))
+    if any(content is None for content in contents.values()):
+        refresh_sparks_in_background(cache_key, owner, repo, branch, "")
+        return "refreshing"
+
+    files = {file["path"]: file for file in cached.get("files", [])}
+    for path in removed:
+        files.pop(path, None)
+    for path, content in contents.items():
+        # Seed the blob and commit caches so the next full crawl reuses them.
+        sha = git_blob_sha(content)
+        blob_cache.set(sha, content)
+        last_commit_cache.set(f"{owner}/{repo}:{branch}:{path}@{sha}", changed[path])
+        files[path] = {
+            "name": path.split("/")[-1],
+            "path": path,
+            "sha": sha,
+            "content": content,
+            "lastCommit": changed[path] or None,
+        }
+
+    data = {**cached, "files": list(files.values())}
+    stored_at = int(time.time() * 1000)
+    spark_cache.set(cache_key, data, stored_at=stored_at)
+    sync_search_indexes(cache_key, data["files"], stored_at)
+    get_issue_store(owner, repo).register_names([spark_name_from_path(path) for path in contents])
+    return "updated"
+
+
+@app.post("/api/webhooks/github")
+def github_webhook():
+    """Receive GitHub webhook deliveries and update caches in place.
+
+    Deliveries must be signed with GITHUB_WEBHOOK_SECRET (X-Hub-Signature-256).
+    Handles:
+      - push: patches the cached spark listing and search indexes of the branch
+      - pull_request: updates that PR in the repository's PR/file index
+      - issues: updates that issue in the repository's issue store
+    Only caches that already exist are touched; nothing is crawled eagerly.
+    """
+    secret = os.environ.get("GITHUB_WEBHOOK_SECRET")
+    if not secret:
+        return jsonify({"error": "Webhooks are not configured (GITHUB_WEBHOOK_SECRET is not set)"}), 503
+
+    body = request.get_data()
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, request.headers.get("X-Hub-Signature-256", "")):
+        record_webhook_stat("rejected")
+        return jsonify({"error": "Invalid signature"}), 401
+    record_webhook_stat("received")
+
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        return jsonify({"error": "Invalid JSON payload"}), 400
+
+    event = request.headers.get("X-GitHub-Event", "")
+    if event == "ping":
+        return jsonify({"event": event, "result": "pong"})
+
+    full_name = (payload.get("repository") or {}).get("full_name") or ""
+    if "/" not in full_name:
+        return jsonify({"error": "repository.full_name is required"}), 400
+    owner, repo = full_name.split("/", 1)
+    repo_key = f"{owner}/{repo}"
+
+    result = "ignored"
+    if event == "push":
+        ref = payload.get("ref") or ""
+        if ref.startswith("refs/heads/"):
+            result = apply_spark_push(owner, repo, ref[len("refs/heads/"):], payload)
+    elif event == "pull_request":
+        for cache_key in [key for key in pr_cache.keys() if key.startswith(f"{repo_key}:")]:
+            pr_cache.pop(cache_key)
+        pr_index = pr_indexes.get(repo_key)
+        if pr_index is not None:
+            pr_index.apply_pull_event(payload.get("pull_request") or {}, build_github_headers())
+            pr_index.publish_update()
+            result = "updated"
+        else:
+            bump_shared_generation(f"prs:{repo_key}")
+    elif event == "issues":
+        issue_store = issue_stores.get(repo_key)
+        issue = payload.get("issue") or {}
+        if issue_store is not None and issue.get("number"):
+            if payload.get("action") == "deleted":
+                issue_store.remove(issue["number"])
+            else:
+                issue_store.upsert([issue], advance_since=False)
+            issue_store.publish_update()
+            result = "updated"
+        else:
+            bump_shared_generation(f"issues:{repo_key}")
+
+    if result in ("updated", "dropped", "refreshing"):
+        record_webhook_stat("applied")
+    return jsonify({"event": event, "result": result})
+
+
 @app.get("/")
 @app.get("/<path:path>")
 def serve_ui(path: Optional[str] = None):
@@ -1271,4 +4870,6 @@ def serve_ui(path: Optional[str] = None):
 
 if __name__ == "__main__":
     port = int(get_env("PORT", "8080"))
+    start_tokenizer_loading()
+    start_warmup()
     app.run(host="0.0.0.0", port=port)
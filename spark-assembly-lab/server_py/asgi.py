@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Spark Assembly Lab ASGI entrypoint.
+
+Serves the same routes as app.py from a single asyncio process:
+
+    uvicorn asgi:app --app-dir server_py --host 0.0.0.0 --port 8080
+
+The model-backed routes (/api/agents/run, /api/workbench/message,
+/api/model/infer) run natively on the event loop with the async OpenAI and
+Anthropic clients, so a slow model turn holds no thread while it waits.
+Every other route is handed to the Flask app on a bounded thread pool
+(ASGI_THREADPOOL_SIZE); their GitHub calls keep using the shared keep-alive
+connection pool and caches in app.py. Request and response bodies are the
+same as under Flask.
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app import (
+    ApiError,
+    CircuitOpenError,
+    agent_request_kwargs,
+    anthropic_response_text,
+    app as flask_app,
+    count_resilience,
+    finalize_agent_run,
+    finalize_model_infer,
+    format_sse,
+    get_breaker,
+    get_env,
+    is_retryable_llm_error,
+    llm_response_cache,
+    llm_usage_report,
+    prepare_agent_run,
+    prepare_model_infer,
+    prepare_workbench_turn,
+    resilience_policy,
+    retry_delay,
+    start_tokenizer_loading,
+    start_warmup,
+    ReplyStreamExtractor,
+)
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Threads for Flask routes and for the blocking parts of native routes
+# (prompt packing, retrieval, response cache writes).
+io_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ASGI_THREADPOOL_SIZE", "64")),
+    thread_name_prefix="asgi-io",
+)
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+
+async def read_body(receive: Receive) -> bytes:
+    chunks: List[bytes] = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def header_value(scope: Scope, name: bytes) -> str:
+    for key, value in scope.get("headers", []):
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return ""
+
+
+async def send_json(send: Send, body: Any, status: int = 200) -> None:
+    data = json.dumps(body).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+
+async def send_sse(receive: Receive, send: Send, events: AsyncIterator[str]) -> None:
+    """Stream SSE events, stopping the upstream model stream if the client leaves."""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    async def relay() -> None:
+        async for event in events:
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_for_disconnect() -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(relay()), asyncio.ensure_future(wait_for_disconnect())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
+
+
+def wants_event_stream(scope: Scope, payload: Dict[str, Any]) -> bool:
+    return payload.get("stream") is True or "text/event-stream" in header_value(scope, b"accept")
+
+
+async def stream_openai_text(
+    client: Any, usage_sink: Optional[Dict[str, int]] = None, **kwargs: Any
+) -> AsyncIterator[str]:
+    """Yield the text deltas of a streamed OpenAI chat completion."""
+    if usage_sink is not None:
+        kwargs["stream_options"] = {"include_usage": True}
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    async for chunk in stream:
+        if usage_sink is not None and getattr(chunk, "usage", None):
+            usage_sink.update(llm_usage_report(chunk.usage))
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
+async def stream_anthropic_text(
+    client: Any, usage_sink: Optional[Dict[str, int]] = None, **kwargs: Any
+) -> AsyncIterator[str]:
+    """Yield the text deltas of a streamed Anthropic message."""
+    async with client.messages.stream(**kwargs) as stream:
+        async for text in stream.text_stream:
+            if text:
+                yield text
+        if usage_sink is not None:
+            usage_sink.update(llm_usage_report((await stream.get_final_message()).usage) or {})
+
+
+async def call_llm(provider: str, endpoint: str, func: Callable[[], Awaitable[Any]]) -> Any:
+    """Async counterpart of app.call_llm (same policies and breakers)."""
+    policy = resilience_policy(endpoint, provider)
+    breaker = get_breaker(provider)
+    attempts = max(1, int(policy["attempts"]))
+    for attempt in range(attempts):
+        probe = breaker.allow()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception as err:
+            if not is_retryable_llm_error(err):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise
+            count_resilience("retries", provider)
+            await asyncio.sleep(retry_delay(policy, attempt))
+            continue
+        breaker.record_success()
+        return result
+
+
+async def guard_llm_stream(provider: str, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Async counterpart of app.guard_llm_stream."""
+    breaker = get_breaker(provider)
+    probe = breaker.allow()
+    settled = False
+    try:
+        async for delta in deltas:
+            yield delta
+    except Exception as err:
+        settled = True
+        if is_retryable_llm_error(err):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    else:
+        settled = True
+        breaker.record_success()
+    finally:
+        # Disconnects close or cancel the stream (GeneratorExit,
+        # CancelledError) without an outcome; free the probe.
+        if probe and not settled:
+            breaker.release_probe()
+
+
+async def single_delta(content: str) -> AsyncIterator[str]:
+    yield content
+
+
+async def stream_model_reply(
+    deltas: AsyncIterator[str],
+    finalize: Callable[[str], Dict[str, Any]],
+) -> AsyncIterator[str]:
+    """Async counterpart of app.stream_model_reply (same token/done/error events)."""
+    extractor = ReplyStreamExtractor()
+    parts: List[str] = []
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            yield format_sse("token", {"delta": delta, "reply": extractor.feed(delta)})
+        yield format_sse("done", await run_blocking(finalize, "".join(parts)))
+    except json.JSONDecodeError as err:
+        yield format_sse("error", {"error": f"Model returned invalid JSON: {err}"})
+    except Exception as err:  # noqa: BLE001
+        yield format_sse("error", {"error": f"Model stream failed: {err}"})
+
+
+async def run_agent(scope: Scope, payload: Dict[str, Any], receive: Receive, send: Send) -> None:
+    try:
+        run = await run_blocking(prepare_agent_run, payload, True)
+    except ApiError as err:
+        return await send_json(send, err.to_dict(), err.status)
+
+    cached_content = llm_response_cache.get(run["cache_key"]) if run["cache_key"] else None
+    cache_status = "hit" if cached_content is not None else None
+
+    if wants_event_stream(scope, payload):
+        if cached_content is not None:
+            deltas = single_delta(cached_content)
+        elif run["provider"] == "openai":
+            run["usage"] = {}
+            deltas = guard_llm_stream("openai", stream_openai_text(run["client"], run["usage"], **agent_request_kwargs(run)))
+        else:
+            run["usage"] = {}
+            deltas = guard_llm_stream(
+                "anthropic", stream_anthropic_text(run["client"], run["usage"], **agent_request_kwargs(run))
+            )
+        return await send_sse(receive, send, stream_model_reply(
+            deltas,
+            lambda content: finalize_agent_run(run, content, cache_status=cache_status),
+        ))
+
+    try:
+        content = cached_content
+        if content is None:
+            if run["provider"] == "openai":
+                response = await call_llm(
+                    "openai", "agents_run",
+                    lambda: run["client"].chat.completions.create(**agent_request_kwargs(run)),
+                )
+                content = response.choices[0].message.content or ""
+            else:
+                response = await call_llm(
+                    "anthropic", "agents_run",
+                    lambda: run["client"].messages.create(**agent_request_kwargs(run)),
+                )
+                content = anthropic_response_text(response)
+            run["usage"] = llm_usage_report(getattr(response, "usage", None))
+        body = await run_blocking(finalize_agent_run, run, content, cache_status)
+    except json.JSONDecodeError as err:
+        return await send_json(send, {"error": f"Agent returned invalid JSON: {err}"}, 502)
+    except CircuitOpenError as err:
+        return await send_json(send, {"error": str(err)}, 503)
+    except Exception as err:  # noqa: BLE001
+        return await send_json(send, {"error": f"Agent orchestrator failed: {err}"}, 500)
+    await send_json(send, body)
+
+
+async def workbench_message(scope: Scope, payload: Dict[str, Any], receive: Receive, send: Send) -> None:
+    try:
+        turn = await run_blocking(prepare_workbench_turn, payload, True)
+    except ApiError as err:
+        return await send_json(send, err.to_dict(), err.status)
+
+    if wants_event_stream(scope, payload):
+        deltas = guard_llm_stream("openai", stream_openai_text(turn["client"], **turn["request"]))
+        return await send_sse(receive, send, stream_model_reply(deltas, turn["parse"]))
+
+    try:
+        response = await call_llm("openai", "workbench", lambda: turn["client"].chat.completions.create(**turn["request"]))
+        body = turn["parse"](response.choices[0].message.content or "")
+    except json.JSONDecodeError as err:
+        return await send_json(send, {"error": f"OpenAI returned invalid JSON for workbench reply: {err}"}, 502)
+    except CircuitOpenError as err:
+        return await send_json(send, {"error": str(err)}, 503)
+    except Exception as err:  # noqa: BLE001
+        return await send_json(send, {"error": f"OpenAI API error (workbench): {err}"}, 502)
+    await send_json(send, body)
+
+
+async def model_infer(scope: Scope, payload: Dict[str, Any], receive: Receive, send: Send) -> None:
+    try:
+        run = await run_blocking(prepare_model_infer, payload, True)
+    except ApiError as err:
+        return await send_json(send, err.to_dict(), err.status)
+
+    content = llm_response_cache.get(run["cache_key"]) if run["cache_key"] else None
+    if content is not None:
+        return await send_json(send, await run_blocking(finalize_model_infer, run, content, "hit"))
+
+    try:
+        response = await call_llm("openai", "model_infer", lambda: run["client"].chat.completions.create(**run["request"]))
+        content = (response.choices[0].message.content or "").strip()
+    except CircuitOpenError as err:
+        return await send_json(send, {"error": str(err)}, 503)
+    except Exception as err:  # noqa: BLE001
+        return await send_json(send, {"error": f"OpenAI API error (model.infer): {err}"}, 502)
+    await send_json(send, await run_blocking(finalize_model_infer, run, content))
+
+
+NATIVE_ROUTES: Dict[Tuple[str, str], Callable[[Scope, Dict[str, Any], Receive, Send], Awaitable[None]]] = {
+    ("POST", "/api/agents/run"): run_agent,
+    ("POST", "/api/workbench/message"): workbench_message,
+    ("POST", "/api/model/infer"): model_infer,
+}
+
+
+def build_environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+    """Translate an ASGI HTTP scope into a WSGI environ (PEP 3333)."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ: Dict[str, Any] = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for raw_key, raw_value in scope.get("headers", []):
+        key = raw_key.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+            continue
+        key = f"HTTP_{key}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_flask(scope: Scope, body: bytes, send: Send) -> None:
+    """Run the Flask app for one request on the thread pool, streaming its output."""
+    loop = asyncio.get_running_loop()
+    environ = build_environ(scope, body)
+
+    def send_from_thread(message: Dict[str, Any]) -> None:
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run() -> None:
+        response_start: Dict[str, Any] = {}
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any = None) -> Callable[[bytes], None]:
+            response_start.update({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            })
+            return lambda data: None
+
+        result = flask_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not started:
+                    send_from_thread(response_start)
+                    started = True
+                if chunk:
+                    send_from_thread({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not started:
+                send_from_thread(response_start)
+            send_from_thread({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    await loop.run_in_executor(io_executor, run)
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                start_tokenizer_loading()
+                start_warmup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                io_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+    handler = NATIVE_ROUTES.get((scope["method"], scope["path"].rstrip("/") or "/"))
+    if handler is None:
+        return await call_flask(scope, body, send)
+
+    try:
+        payload = json.loads(body) if body else {}
+    except ValueError:
+        payload = {}
+    await handler(scope, payload if isinstance(payload, dict) else {}, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(get_env("PORT", "8080")))
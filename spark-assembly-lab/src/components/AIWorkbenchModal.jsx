@@ -7,7 +7,7 @@ import {
   getBackendConfigForVendor,
 } from '../utils/llmConfig';
 
-export default function AIWorkbenchModal({ sparkData, onClose, onApplyMarkdown }) {
+export default function AIWorkbenchModal({ sparkData, repoUrl, onClose, onApplyMarkdown }) {
   const [{ vendor, apiKey }, setLlmConfig] = useState(() => getActiveLlmConfig());
   const [messages, setMessages] = useState(() => [
     {
@@ -32,7 +32,7 @@ export default function AIWorkbenchModal({ sparkData, onClose, onApplyMarkdown }
     setLlmConfig(getActiveLlmConfig());
   }, []);
 
-  const callOpenAIWorkbench = async (conversation) => {
+  const callOpenAIWorkbench = async (conversation, onReplyDelta) => {
     const cfg = getActiveLlmConfig();
     const { provider, model } = getBackendConfigForVendor(cfg.vendorId);
 
@@ -48,6 +48,9 @@ export default function AIWorkbenchModal({ sparkData, onClose, onApplyMarkdown }
       sparkContent: sparkMarkdown,
       sparkData: { name: sparkData.name },
       messages: conversation.map((m) => ({ role: m.role, content: m.content })),
+      repo: repoUrl,
+      path: sparkData.sourcePath,
+      onReplyDelta,
     });
 
     setLastContext(data.context || null);
@@ -74,17 +77,30 @@ export default function AIWorkbenchModal({ sparkData, onClose, onApplyMarkdown }
     setError(null);
     setSending(true);
 
+    // Show the reply as it streams in, then replace it with the final message.
+    const streamingId = `assistant-${Date.now()}`;
+    const handleReplyDelta = (delta) => {
+      setMessages((prev) => {
+        const existing = prev.find((m) => m.id === streamingId);
+        if (!existing) {
+          return [...prev, { id: streamingId, role: 'assistant', content: delta, updatedSpark: null }];
+        }
+        return prev.map((m) => (m.id === streamingId ? { ...m, content: m.content + delta } : m));
+      });
+    };
+
     try {
-      const result = await callOpenAIWorkbench(baseMessages);
+      const result = await callOpenAIWorkbench(baseMessages, handleReplyDelta);
 
       const assistantMessage = {
-        id: `assistant-${Date.now()}`,
+        id: streamingId,
         role: 'assistant',
         content: result.reply || 'No reply generated.',
         updatedSpark: result.updatedSpark || '',
       };
-      setMessages((prev) => [...prev, assistantMessage]);
+      setMessages((prev) => [...prev.filter((m) => m.id !== streamingId), assistantMessage]);
     } catch (err) {
+      setMessages((prev) => prev.filter((m) => m.id !== streamingId));
       setError(err.message || 'Failed to contact AI');
     } finally {
       setSending(false);
@@ -812,6 +812,7 @@ export default function AssemblyCanvas({ sparkData, onSparkUpdate, repoUrl, orig
           {showQuiz && (
             <AIWorkbenchModal
               sparkData={sparkData}
+              repoUrl={repoUrl}
               onClose={() => setShowQuiz(false)}
               onApplyMarkdown={handleApplySparkMarkdownFromAI}
             />
@@ -2,6 +2,37 @@
 // This centralizes fetch calls so UI components can remain focused
 // on presentation and workflows.
 
+// Parse a Server-Sent Events response body, calling onEvent(event, data)
+// for every JSON event as it arrives.
+async function readEventStream(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf('\n\n');
+
+      let event = 'message';
+      const dataLines = [];
+      rawEvent.split('\n').forEach((line) => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+      });
+      if (dataLines.length) {
+        onEvent(event, JSON.parse(dataLines.join('\n')));
+      }
+    }
+  }
+}
+
 export async function runAgent({
   provider = 'openai',
   apiKey,
@@ -10,7 +41,13 @@ export async function runAgent({
   sparkContent,
   sparkData,
   messages,
+  repo,
+  path,
+  onReplyDelta,
 }) {
+  // When onReplyDelta is given, the reply is streamed over SSE and the
+  // callback receives each new piece of the assistant's reply text.
+  const stream = typeof onReplyDelta === 'function';
   const response = await fetch('/api/agents/run', {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
@@ -22,15 +59,32 @@ export async function runAgent({
       sparkContent,
       sparkData,
       messages,
+      repo,
+      path,
+      stream,
     }),
   });
 
-  const data = await response.json();
-  if (!response.ok) {
-    throw new Error(data?.error || 'Agent orchestrator request failed');
+  if (!stream || !response.ok) {
+    const data = await response.json();
+    if (!response.ok) {
+      throw new Error(data?.error || 'Agent orchestrator request failed');
+    }
+    return data;
   }
 
-  return data;
+  let result = null;
+  let streamError = null;
+  await readEventStream(response, (event, data) => {
+    if (event === 'token' && data.reply) onReplyDelta(data.reply);
+    else if (event === 'done') result = data;
+    else if (event === 'error') streamError = data.error;
+  });
+
+  if (streamError || !result) {
+    throw new Error(streamError || 'Agent stream ended unexpectedly');
+  }
+  return result;
 }
 
 export async function fetchSpark({ repo, path, branch = 'main' }) {